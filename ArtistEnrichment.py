@@ -0,0 +1,156 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from SpotifySimplify import simplify_top_artists
+
+class ArtistEnrichment:
+    '''
+    Local table of Spotify artist details for the artists in the streaming history.
+
+    Artist names are resolved to Spotify artist IDs with one search per name, then the
+    full artist objects are fetched with the multi-ID artists endpoint, up to
+    BATCH_SIZE IDs per request. Both steps run on a thread pool with at most
+    max_workers requests in flight. The table keeps the fields of
+    simplify_top_artists and is keyed on 'master_metadata_album_artist_name', so it
+    joins back onto the streaming history. Only names that are not in the table yet
+    are looked up, unless a refresh is asked for.
+    '''
+
+    ARTISTS_URL = "https://api.spotify.com/v1/artists"
+    BATCH_SIZE = 50  # Most IDs the artists endpoint accepts per request
+    KEY = 'master_metadata_album_artist_name'
+    COUNT_COLUMNS = ['artist_popularity', 'artist_followers']
+    COLUMNS = [KEY, 'artist_name', 'artist_id', 'artist_link', 'artist_genres', 'artist_popularity', 'artist_followers', 'artist_image_640', 'artist_image_300', 'artist_image_64']
+
+    def __init__(self, stats, artists_file, max_workers=8):
+        self.stats = stats  # MySpotifyStats providing the API client and the cached artist search
+        self.artists_file = artists_file  # Parquet file holding the artist table
+        self.max_workers = max_workers
+
+    def load(self) -> pd.DataFrame:
+        if not os.path.exists(self.artists_file):
+            return pd.DataFrame(columns=self.COLUMNS)
+        return pd.read_parquet(self.artists_file)
+
+    def write(self, artists_df: pd.DataFrame):
+        artists_df.to_parquet(self.artists_file + '.tmp', index=False)
+        os.replace(self.artists_file + '.tmp', self.artists_file)
+
+    def resolve_ids(self, token, artist_names) -> tuple:
+        '''
+        This function resolves artist names to Spotify artist IDs concurrently.
+
+        Parameters:
+        token (str): The Spotify API token.
+        artist_names (list): The artist names to resolve.
+
+        Returns:
+        tuple: (ids, failed) where ids (dict) maps each name to its artist ID, or None when Spotify found no artist,
+        and failed (dict) maps the names whose search raised to the error message.
+        '''
+        # the searches count as requests of the calling thread
+        counter = self.stats.api_client.thread_counter()
+
+        def search(artist_name):
+            try:
+                with self.stats.api_client.counting_for(counter):
+                    artist = self.stats.spotify_artist_search(token, artist_name)
+                return artist_name, (artist['id'] if artist else None), None
+            except Exception as e:
+                return artist_name, None, str(e)
+
+        ids, failed = {}, {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for artist_name, artist_id, error in executor.map(search, artist_names):
+                if error is None:
+                    ids[artist_name] = artist_id
+                else:
+                    failed[artist_name] = error
+        return ids, failed
+
+    def fetch_artists(self, token, artist_ids) -> tuple:
+        '''
+        This function fetches full artist objects for many IDs with concurrent batched requests.
+
+        Parameters:
+        token (str): The Spotify API token.
+        artist_ids (list): The Spotify artist IDs to fetch.
+
+        Returns:
+        tuple: (artists, failed) where artists (dict) maps each fetched ID to its artist object and failed (dict) maps the IDs of batches that could not be fetched to the error message.
+        '''
+        artist_ids = list(dict.fromkeys(artist_ids))
+        batches = [artist_ids[i:i + self.BATCH_SIZE] for i in range(0, len(artist_ids), self.BATCH_SIZE)]
+        headers = {
+            "Authorization": f"Bearer {token}",
+        }
+
+        counter = self.stats.api_client.thread_counter()
+
+        def fetch(batch):
+            # A connection error that outlasted the client's retries only fails its own batch
+            try:
+                with self.stats.api_client.counting_for(counter):
+                    response = self.stats.api_client.get(self.ARTISTS_URL, headers=headers, params={'ids': ','.join(batch)})
+                if response.status_code != 200:
+                    return batch, None, f"Failed to fetch artists: HTTP {response.status_code}."
+                return batch, [artist for artist in response.json().get('artists', []) if artist], None
+            except Exception as e:
+                return batch, None, str(e)
+
+        artists, failed = {}, {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for batch, batch_artists, error in executor.map(fetch, batches):
+                if batch_artists is None:
+                    failed.update(dict.fromkeys(batch, error))
+                    continue
+                for artist in batch_artists:
+                    artists[artist['id']] = artist
+        return artists, failed
+
+    def enrich(self, token, artist_names, refresh=False) -> dict:
+        '''
+        This function adds the artists missing from the artist table and saves it.
+        Names Spotify has no artist for are stored with empty details so they are not searched again; names whose lookup failed are left out and retried next time.
+
+        Parameters:
+        token (str): The Spotify API token.
+        artist_names (list): The artist names from the streaming history.
+        refresh (bool): Look every name up again instead of only the missing ones.
+
+        Returns:
+        dict: The number of 'added' rows, the 'not_found' names and the 'failed' names with their error messages.
+        '''
+        artists_df = self.load()
+        artist_names = [name for name in dict.fromkeys(artist_names) if isinstance(name, str) and name]
+        if not refresh:
+            known = set(artists_df[self.KEY])
+            artist_names = [name for name in artist_names if name not in known]
+        if not artist_names:
+            return {'added': 0, 'not_found': [], 'failed': {}}
+
+        ids, failed = self.resolve_ids(token, artist_names)
+        artists, failed_ids = self.fetch_artists(token, [artist_id for artist_id in ids.values() if artist_id])
+
+        rows = []
+        not_found = []
+        for artist_name, artist_id in ids.items():
+            if artist_id is None:
+                not_found.append(artist_name)
+                rows.append({self.KEY: artist_name})
+            elif artist_id in artists:
+                rows.append({self.KEY: artist_name, **simplify_top_artists([artists[artist_id]])[0]})
+            elif artist_id in failed_ids:
+                failed[artist_name] = failed_ids[artist_id]
+            else:
+                # An ID the artists endpoint does not know any more
+                not_found.append(artist_name)
+                rows.append({self.KEY: artist_name})
+
+        if rows:
+            new_rows = pd.DataFrame(rows, columns=self.COLUMNS)
+            frames = [frame for frame in (artists_df, new_rows) if not frame.empty]
+            artists_df = pd.concat(frames, ignore_index=True).drop_duplicates(subset=self.KEY, keep='last')
+            self.write(artists_df.astype({column: ('Int64' if column in self.COUNT_COLUMNS else object) for column in self.COLUMNS}))
+
+        return {'added': len(rows), 'not_found': not_found, 'failed': failed}
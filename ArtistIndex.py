@@ -0,0 +1,59 @@
+import bisect
+import numpy as np
+import pandas as pd
+
+class ArtistIndex:
+    '''
+    Lower-cased index over the distinct artist names of the listening cube.
+
+    Each name is mapped to its category code, and the folded names are kept sorted so
+    a prefix lookup is a binary search for the block of names starting with the prefix
+    instead of a regex scan over every row. Names are lower-cased rather than case-folded
+    so the lookup agrees with a case-insensitive regex match, e.g. 'strasse' does not
+    match 'Straße'.
+    '''
+
+    def __init__(self, artist_names):
+        self.artist_names = pd.Index(artist_names)  # Artist names in category code order
+        lowered = [self.normalise(name) for name in self.artist_names]
+        order = sorted(range(len(lowered)), key=lowered.__getitem__)
+        self.sorted_names = [lowered[i] for i in order]
+        self.sorted_codes = np.array(order, dtype=np.int64)
+
+    @staticmethod
+    def normalise(artist_name) -> str:
+        return str(artist_name).lower()
+
+    # Characters that make a pattern more than a literal string in a regex match
+    REGEX_METACHARACTERS = frozenset('.^$*+?{}[]\\|()')
+
+    @classmethod
+    def is_literal(cls, artist_name) -> bool:
+        # True when the name has no regex metacharacters, so a regex match on it is a plain prefix match
+        return not cls.REGEX_METACHARACTERS.intersection(artist_name)
+
+    def lookup(self, artist_name, prefix=True) -> np.ndarray:
+        '''
+        This function finds the category codes of the artists matching a name.
+
+        Parameters:
+        artist_name (str): The artist name, compared case-insensitively.
+        prefix (bool): Match every artist whose name starts with artist_name rather than only the exact name.
+
+        Returns:
+        np.ndarray: The matching category codes.
+        '''
+        name = self.normalise(artist_name)
+        lo = bisect.bisect_left(self.sorted_names, name)
+        if prefix:
+            # Names starting with the prefix sort between the prefix and the prefix followed by the highest code point
+            hi = bisect.bisect_left(self.sorted_names, name + '\U0010ffff')
+        else:
+            hi = bisect.bisect_right(self.sorted_names, name)
+        return self.sorted_codes[lo:hi]
+
+    def match(self, artist_pattern) -> np.ndarray:
+        # Codes of the artists a case-insensitive regex match of artist_pattern accepts, the same rows str.match(case=False) selects
+        if self.is_literal(artist_pattern):
+            return self.lookup(artist_pattern, prefix=True)
+        return np.flatnonzero(self.artist_names.str.match(artist_pattern, case=False))
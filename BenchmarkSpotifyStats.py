@@ -0,0 +1,393 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import threading
+import tracemalloc
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Benchmarks loading the streaming history, the stat methods and the PocketBase writes on synthetic exports.
+# Each history size runs in its own process so the peak memory of one size does not hide the next one.
+# Results are printed (or written with --output) as JSON and can be compared against a stored baseline with --baseline.
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+BENCHMARK_YEAR = 2024  # The synthetic history covers 2015 to 2025, so every range has data
+RANGE_START = '2024-01-01'
+RANGE_END = '2024-12-31'
+BENCHMARK_ARTIST = 'Artist 1'
+RECORD_IDS = ['k79p34vx2t81ppm', 'g1u3v64la2ufpyx', 'cvcl26dhoq3698a', 'ncdzc3y1paeayj4', '3726130j114pzzm', '723y18jg6z2srvx', '7pc06xg3ix8c847']
+
+
+class StubPocketBaseHandler(BaseHTTPRequestHandler):
+    # Answers the PocketBase endpoints SpotifyStatsModel uses with canned JSON after an artificial delay
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    records = {}
+    lock = threading.Lock()
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+    def record(self, record_id, fields=None):
+        with self.lock:
+            record = self.records.setdefault(record_id, {'id': record_id, 'collectionId': 'stats', 'collectionName': 'stats', 'created': '', 'updated': '', 'value': None})
+            if fields:
+                record.update(fields)
+            return dict(record)
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        self.read_body()
+        admin = {'id': 'admin', 'email': 'admin@example.com', 'created': '', 'updated': '', 'avatar': 0}
+        if self.path.startswith('/api/admins/auth-with-password'):
+            return self.reply(200, {'token': 'stub-token', 'admin': admin})
+        if self.path.startswith('/api/collections/_superusers/auth-with-password'):
+            return self.reply(200, {'token': 'stub-token', 'record': dict(admin, collectionId='_superusers', collectionName='_superusers')})
+        self.reply(404, {'code': 404, 'message': 'Not found.', 'data': {}})
+
+    def do_PATCH(self):
+        time.sleep(self.latency)
+        record_id = self.path.split('?')[0].rstrip('/').rsplit('/', 1)[-1]
+        self.reply(200, self.record(record_id, self.read_body()))
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        record_id = self.path.split('?')[0].rstrip('/').rsplit('/', 1)[-1]
+        self.reply(200, self.record(record_id))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_pocketbase(latency):
+    '''
+    This function starts a local stub PocketBase server on a free port in a background thread.
+
+    Parameters:
+    latency (float): Seconds every request is delayed, standing in for the network round trip.
+
+    Returns:
+    tuple: (server, url) The running server, stopped with server.shutdown(), and its base URL.
+    '''
+    handler = type('Handler', (StubPocketBaseHandler,), {'latency': latency, 'records': {}})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def stub_stats_model(url, max_in_flight=8, write_cache_file=None):
+    '''
+    This function creates a SpotifyStatsModel writing to a stub PocketBase server.
+    The admin authentication is skipped: the stub issues no real token and its response format differs between PocketBase SDK versions.
+
+    Parameters:
+    url (str): Base URL of the stub server, as returned by start_stub_pocketbase.
+    max_in_flight (int): Concurrent requests of the bulk writes.
+    write_cache_file (str): Write cache file of the model. None writes every update.
+
+    Returns:
+    SpotifyStatsModel: The model.
+    '''
+    from SpotifyStatsModel import SpotifyStatsModel
+
+    class StubStatsModel(SpotifyStatsModel):
+        def authenticate(self, admin_email, admin_password):
+            return None
+
+    return StubStatsModel(url, 'stats', 'admin@example.com', 'benchmark', max_in_flight, write_cache_file)
+
+
+def time_call(function, repeat):
+    # Time repeat calls of function, the first call is reported separately since later ones may hit caches
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return {'first': durations[0], 'median': statistics.median(durations), 'min': min(durations), 'runs': repeat}
+
+
+def peak_rss_bytes():
+    # Peak resident set size of this process and of its largest finished child (the parsing workers); ru_maxrss is in KiB on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return {'self': own, 'children': children}
+
+
+def write_config(directory, export_dir, cache_path, low_memory):
+    # A config.ini with dummy API secrets pointing the stats at the synthetic export
+    config_file = os.path.join(directory, 'config.ini')
+    with open(config_file, 'w') as f:
+        f.write('[Spotify_API]\n\n')
+        f.write('[Spotify_API_Secrets]\nspotify_client_id = benchmark\nspotify_client_secret = benchmark\nspotify_client_code = benchmark\nspotify_redirect_uri = http://localhost\n\n')
+        f.write(f'[Spotify_Data]\nspotify_streaming_history_path = {export_dir}\nspotify_streaming_history_cache_path = {cache_path}\n')
+        f.write(f"spotify_streaming_history_low_memory = {'true' if low_memory else 'false'}\nspotify_timezone = America/Barbados\n")
+    return config_file
+
+
+def prepare_export(workdir, rows, rows_per_file, seed):
+    # Generate the synthetic export for a size once and reuse it while the parameters stay the same
+    from SyntheticStreamingHistory import generate_streaming_history
+    export_dir = os.path.join(workdir, f'export_{rows}')
+    marker_file = os.path.join(export_dir, 'generated.json')
+    params = {'rows': rows, 'rows_per_file': rows_per_file, 'seed': seed}
+    if os.path.exists(marker_file):
+        with open(marker_file) as f:
+            if json.load(f) == params:
+                return export_dir, 0.0
+    start = time.perf_counter()
+    generate_streaming_history(export_dir, rows, rows_per_file=rows_per_file, seed=seed)
+    with open(marker_file, 'w') as f:
+        json.dump(params, f)
+    return export_dir, time.perf_counter() - start
+
+
+def benchmark_history(rows, workdir, rows_per_file, seed, repeat, low_memory, trace_memory):
+    '''
+    This function benchmarks one history size: loading it cold and warm and every stat method.
+
+    Parameters:
+    rows (int): Number of plays in the synthetic history.
+    workdir (str): Directory holding the generated exports and caches.
+    rows_per_file (int): Plays per export file.
+    seed (int): Seed of the synthetic history.
+    repeat (int): Number of timed calls of each stat method.
+    low_memory (bool): Load the history in low memory mode.
+    trace_memory (bool): Also report the peak Python allocation of the cold load with tracemalloc, which slows it down.
+
+    Returns:
+    dict: Timings in seconds and memory in bytes.
+    '''
+    import shutil
+    from MySpotifyStats import MySpotifyStats
+
+    export_dir, generate_seconds = prepare_export(workdir, rows, rows_per_file, seed)
+    run_dir = os.path.join(workdir, f'run_{rows}_{"low_memory" if low_memory else "full"}')
+    cache_path = os.path.join(run_dir, 'streaming_history_cache')
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(run_dir)
+    config_file = write_config(run_dir, export_dir, cache_path, low_memory)
+
+    result = {'rows': rows, 'files': len([f for f in os.listdir(export_dir) if 'Streaming_History_Audio' in f]), 'low_memory': low_memory, 'generate_seconds': generate_seconds}
+    rss_before = peak_rss_bytes()
+
+    start = time.perf_counter()
+    stats = MySpotifyStats(config_file)
+    result['setup_seconds'] = time.perf_counter() - start
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    stats.load()
+    result['load_cold_seconds'] = time.perf_counter() - start
+    if trace_memory:
+        result['load_cold_traced_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    rss_after = peak_rss_bytes()
+    result['peak_rss_bytes'] = rss_after['self']
+    result['load_cold_rss_growth_bytes'] = rss_after['self'] - rss_before['self']
+    result['worker_peak_rss_bytes'] = rss_after['children']
+
+    start = time.perf_counter()
+    warm = MySpotifyStats(config_file)
+    warm.load()
+    result['load_warm_seconds'] = time.perf_counter() - start
+    result['memory_footprint_bytes'] = warm.get_memory_footprint()['total']
+    del stats
+
+    methods = {
+        'get_total_listening': lambda: warm.get_total_listening(),
+        'get_total_listening_range': lambda: warm.get_total_listening(RANGE_START, RANGE_END),
+        'get_total_listening_by_month': lambda: warm.get_total_listening_by_month(BENCHMARK_YEAR),
+        'get_average_listening': lambda: warm.get_average_listening(RANGE_START, RANGE_END),
+        'get_hour_listened': lambda: warm.get_hour_listened(RANGE_START, RANGE_END),
+        'get_artist_listening_time': lambda: warm.get_artist_listening_time(BENCHMARK_ARTIST, RANGE_START, RANGE_END),
+        'get_local_top_tracks': lambda: warm.get_local_top_tracks(RANGE_START, RANGE_END),
+        'get_streaming_history_range': lambda: warm.get_streaming_history(RANGE_START, RANGE_END),
+    }
+    result['methods'] = {name: time_call(method, repeat) for name, method in methods.items()}
+    result['peak_rss_bytes'] = peak_rss_bytes()['self']
+    return result
+
+
+def benchmark_pocketbase(latency, repeat, max_in_flight):
+    '''
+    This function times writing the seven stats with SpotifyStatsModel against a local stub PocketBase server.
+
+    Parameters:
+    latency (float): Seconds the stub delays every request.
+    repeat (int): Number of timed rounds.
+    max_in_flight (int): Concurrent requests used by the bulk write.
+
+    Returns:
+    dict: Timings in seconds of writing the stats one by one and with update_stats_bulk, or the 'error' when the model could not be used.
+    '''
+    server, url = start_stub_pocketbase(latency)
+    try:
+        try:
+            model = stub_stats_model(url, max_in_flight)
+        except Exception as e:
+            return {'error': f'{type(e).__name__}: {e}'}
+        updates = [(record_id, f'stat_{i}', {'value': i, 'items': list(range(24))}) for i, record_id in enumerate(RECORD_IDS)]
+
+        def sequential():
+            for update in updates:
+                model.update_stats(*update)
+
+        def bulk():
+            results = model.update_stats_bulk(updates)
+            failed = [record_id for record_id, outcome in results.items() if not outcome['success']]
+            if failed:
+                raise Exception(f"Stub PocketBase writes failed for {failed}.")
+
+        return {
+            'latency_seconds': latency,
+            'records': len(updates),
+            'max_in_flight': max_in_flight,
+            'sequential': time_call(sequential, repeat),
+            'bulk': time_call(bulk, repeat),
+        }
+    finally:
+        server.shutdown()
+
+
+def section_errors(results, prefix='') -> dict:
+    # The error of every benchmark section that could not run, keyed on its dotted path
+    errors = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            if 'error' in value:
+                errors[f'{prefix}{key}'] = value['error']
+            else:
+                errors.update(section_errors(value, f'{prefix}{key}.'))
+    return errors
+
+
+def flatten_timings(results, prefix=''):
+    # Map every timing in the results to a dotted path, using the median of repeated calls
+    timings = {}
+    for key, value in results.items():
+        path = f'{prefix}{key}'
+        if isinstance(value, dict) and 'median' in value:
+            timings[path] = value['median']
+        elif isinstance(value, dict):
+            timings.update(flatten_timings(value, path + '.'))
+        elif key.endswith('_seconds') and key != 'generate_seconds' and key != 'latency_seconds' and isinstance(value, (int, float)):
+            timings[path] = value
+    return timings
+
+
+def compare_with_baseline(results, baseline, threshold, min_seconds=0.001):
+    '''
+    This function compares the timings of a run with a stored baseline run.
+
+    Parameters:
+    results (dict): This run's results.
+    baseline (dict): The results of an earlier run.
+    threshold (float): Ratio of current to baseline time above which a timing counts as a regression.
+    min_seconds (float): Timings below this in both runs are ignored as noise.
+
+    Returns:
+    list: One dict per regression with the 'metric', 'baseline' and 'current' seconds and their 'ratio'.
+    '''
+    current = flatten_timings(results['benchmarks'])
+    previous = flatten_timings(baseline['benchmarks'])
+    regressions = []
+    for metric, seconds in sorted(current.items()):
+        before = previous.get(metric)
+        if before is None or max(before, seconds) < min_seconds:
+            continue
+        ratio = seconds / before if before else float('inf')
+        if ratio > threshold:
+            regressions.append({'metric': metric, 'baseline': before, 'current': seconds, 'ratio': ratio})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark MySpotifyStats and SpotifyStatsModel on synthetic streaming history.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Numbers of plays to benchmark.')
+    parser.add_argument('--rows-per-file', type=int, default=15000, help='Plays per generated export file.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic history.')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed calls of each stat method.')
+    parser.add_argument('--low-memory', action='store_true', help='Load the history in low memory mode.')
+    parser.add_argument('--tracemalloc', action='store_true', help='Also trace the peak Python allocation of the cold load.')
+    parser.add_argument('--workdir', default='benchmark_data', help='Directory for the generated exports and caches.')
+    parser.add_argument('--pocketbase-latency', type=float, default=0.02, help='Seconds the stub PocketBase server delays every request.')
+    parser.add_argument('--max-in-flight', type=int, default=8, help='Concurrent requests of the bulk PocketBase write.')
+    parser.add_argument('--skip-pocketbase', action='store_true', help='Do not benchmark the PocketBase writes.')
+    parser.add_argument('--output', help='Write the results to this JSON file instead of printing them.')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against.')
+    parser.add_argument('--threshold', type=float, default=1.25, help='Slowdown ratio against the baseline reported as a regression.')
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # The history benchmarks run in the script directory, resolve the work directory against the caller's
+    args.workdir = os.path.abspath(args.workdir)
+
+    if args.worker is not None:
+        # Child process benchmarking a single size, the results go to stdout
+        result = benchmark_history(args.worker, args.workdir, args.rows_per_file, args.seed, args.repeat, args.low_memory, args.tracemalloc)
+        print(json.dumps(result))
+        return 0
+
+    os.makedirs(args.workdir, exist_ok=True)
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('worker', 'output', 'baseline')},
+        'benchmarks': {'history': {}},
+    }
+    for rows in args.sizes:
+        command = [sys.executable, os.path.abspath(__file__), '--worker', str(rows), '--workdir', args.workdir, '--rows-per-file', str(args.rows_per_file), '--seed', str(args.seed), '--repeat', str(args.repeat)]
+        if args.low_memory:
+            command.append('--low-memory')
+        if args.tracemalloc:
+            command.append('--tracemalloc')
+        completed = subprocess.run(command, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        if completed.returncode != 0:
+            results['benchmarks']['history'][str(rows)] = {'error': completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else f'exit code {completed.returncode}'}
+            continue
+        results['benchmarks']['history'][str(rows)] = json.loads(completed.stdout.strip().splitlines()[-1])
+
+    if not args.skip_pocketbase:
+        results['benchmarks']['pocketbase'] = benchmark_pocketbase(args.pocketbase_latency, args.repeat, args.max_in_flight)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['regressions'] = compare_with_baseline(results, json.load(f), args.threshold)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    for regression in results.get('regressions', []):
+        print(f"Regression {regression['metric']}: {regression['baseline']:.4f}s -> {regression['current']:.4f}s ({regression['ratio']:.2f}x)", file=sys.stderr)
+    errors = section_errors(results['benchmarks'])
+    for section, error in errors.items():
+        print(f"Benchmark {section} failed: {error}", file=sys.stderr)
+    return 1 if results.get('regressions') or errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,15 +1,146 @@
 import os
+import stat
+import tempfile
+import threading
+import contextlib
 import configparser
 
+try:
+    import fcntl
+except ImportError:
+    # No advisory file locks on this platform, writes are still atomic but not serialised between processes
+    fcntl = None
+
 class Config:
+    '''
+    Cached access to the ini config file.
+
+    The file is parsed once and kept in memory, and parsed again only when its
+    modification time or size changes. set_config_value writes through to the file;
+    inside a batch() block the values are collected and written together when the
+    block exits. Every write holds an exclusive lock on a sidecar lock file, merges
+    the values into the current file contents and replaces the file atomically with
+    a temporary file, so concurrent jobs never see or leave a half written file.
+    '''
+
     def __init__(self, config_file):
         self.CONFIG_FILE = config_file  # Path to the ini config file
+        self.LOCK_FILE = config_file + '.lock'
+        self.parser = None
+        self.signature = None  # (mtime_ns, size) of the file when it was parsed
+        self.pending = {}  # section -> {key: value} written by set_config_value and not yet persisted
+        self.batch_depth = 0
+        self.lock = threading.RLock()
+
+    def file_signature(self):
+        try:
+            file_stat = os.stat(self.CONFIG_FILE)
+        except FileNotFoundError:
+            return None
+        return (file_stat.st_mtime_ns, file_stat.st_size)
 
-    def get_config_value(self, section, key):
+    def read_file(self) -> configparser.ConfigParser:
         config = configparser.ConfigParser()
         config.read(self.CONFIG_FILE)
-        return config.get(section, key)
+        return config
+
+    def load(self) -> configparser.ConfigParser:
+        # Parse the file again only when it changed on disk since the last parse, keeping the values not yet persisted
+        with self.lock:
+            signature = self.file_signature()
+            if self.parser is None or signature != self.signature:
+                self.parser = self.read_file()
+                self.signature = signature
+                self.apply(self.parser, self.pending)
+            return self.parser
+
+    @staticmethod
+    def apply(config, values):
+        for section, section_values in values.items():
+            if not config.has_section(section):
+                config.add_section(section)
+            for key, value in section_values.items():
+                config.set(section, key, value)
+
+    def get_config_value(self, section, key, fallback=configparser._UNSET):
+        # fallback is returned when the section or key is missing. Without it a missing value raises as before.
+        return self.load().get(section, key, fallback=fallback)
 
     def set_config_value(self, section, key, value):
-        config = configparser.ConfigParser()
-        config.read(self.CONFIG_FILE)
\ No newline at end of file
+        '''
+        This function sets a config value and persists it to the config file.
+        Inside a batch() block the value is only persisted when the outermost block exits.
+
+        Parameters:
+        section (str): The config section, created when missing.
+        key (str): The config key.
+        value (str): The new value.
+
+        Returns:
+        None
+        '''
+        with self.lock:
+            self.pending.setdefault(section, {})[key] = str(value)
+            self.apply(self.load(), {section: {key: str(value)}})
+            if self.batch_depth == 0:
+                self.flush()
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        This function groups the set_config_value calls made inside the block into one write of the config file.
+        '''
+        with self.lock:
+            self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    self.flush()
+
+    @contextlib.contextmanager
+    def file_lock(self):
+        # Exclusive lock held by one writer across processes
+        if fcntl is None:
+            yield
+            return
+        with open(self.LOCK_FILE, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def flush(self):
+        '''
+        This function persists the pending values.
+        The file is read again under the lock so values written by other jobs in the meantime are kept.
+        '''
+        with self.lock:
+            if not self.pending:
+                return
+            with self.file_lock():
+                config = self.read_file()
+                self.apply(config, self.pending)
+
+                directory = os.path.dirname(os.path.abspath(self.CONFIG_FILE))
+                fd, tmp_config_file = tempfile.mkstemp(prefix='.config-', suffix='.tmp', dir=directory)
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        config.write(f)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    if os.path.exists(self.CONFIG_FILE):
+                        # Keep the permissions of the file, it holds secrets
+                        os.chmod(tmp_config_file, stat.S_IMODE(os.stat(self.CONFIG_FILE).st_mode))
+                    os.replace(tmp_config_file, self.CONFIG_FILE)
+                except BaseException:
+                    if os.path.exists(tmp_config_file):
+                        os.remove(tmp_config_file)
+                    raise
+
+                self.pending = {}
+                self.parser = config
+                self.signature = self.file_signature()
@@ -0,0 +1,219 @@
+import os
+import io
+import sys
+import json
+import time
+import cProfile
+import resource
+import threading
+import functools
+import contextlib
+import tracemalloc
+
+class Instrumentation:
+    '''
+    Per-stage timing and memory spans for a pipeline run.
+
+    A span records the wall time, the CPU time of the thread running it and of finished
+    child processes, the change in resident memory and in peak resident memory, an optional
+    row count and the number of HTTP requests it sent. HTTP requests are counted with
+    the counters passed to add_http_counter, callables returning a running total of
+    the requests sent for the calling thread, so the requests of spans running at the
+    same time on other threads are not counted. Spans nest; each one records the name
+    of the span it ran in and its start relative to the run, and spans are listed in
+    the order they finished.
+    Stages named in profile_stages are also run under cProfile and tracemalloc: the
+    profile is written next to the report and the largest allocations are added to
+    the span. The report is written as JSON or, for a .prom path, in the Prometheus
+    text format. When spans overlap on several threads the CPU time still belongs to
+    the span's own thread, but the memory and child process measures are process wide
+    and include the work of the other threads.
+    '''
+
+    def __init__(self, profile_stages=(), profile_dir=None):
+        self.spans = []
+        self.profile_stages = set(profile_stages)  # Stage names run under cProfile and tracemalloc
+        self.profile_dir = profile_dir  # Directory the .prof files are written to, the working directory when None
+        self.http_counters = {}
+        self.local = threading.local()
+        self.started = time.time()
+
+    def add_http_counter(self, name, counter):
+        # counter returns the number of HTTP requests one client sent so far for the calling thread
+        self.http_counters[name] = counter
+
+    def http_counts(self) -> dict:
+        return {name: counter() for name, counter in list(self.http_counters.items())}
+
+    @staticmethod
+    def rss_bytes() -> int:
+        # Current resident set size, read from /proc on Linux and approximated by the peak elsewhere
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            return Instrumentation.peak_rss_bytes()
+
+    @staticmethod
+    def peak_rss_bytes() -> int:
+        # ru_maxrss is in KiB on Linux and bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+    @staticmethod
+    def child_cpu_seconds() -> float:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+
+    @contextlib.contextmanager
+    def span(self, name, rows=None):
+        '''
+        This function measures the code run inside the block as one stage.
+
+        Parameters:
+        name (str): The stage name.
+        rows (int): Number of rows the stage handles, if known up front. It can also be set on the yielded span dict.
+
+        Returns:
+        dict: The span record, filled in when the block exits.
+        '''
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        record = {'name': name, 'parent': stack[-1]['name'] if stack else None, 'rows': rows, 'start_seconds': time.time() - self.started}
+        stack.append(record)
+
+        profiler = None
+        tracing = False
+        if name in self.profile_stages:
+            profiler = cProfile.Profile()
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                tracing = True
+
+        http_before = self.http_counts()
+        rss_before = self.rss_bytes()
+        peak_before = self.peak_rss_bytes()
+        cpu_before = time.thread_time()
+        child_cpu_before = self.child_cpu_seconds()
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+            record['status'] = 'ok'
+        except BaseException as e:
+            record['status'] = 'error'
+            record['error'] = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record['wall_seconds'] = time.perf_counter() - start
+            record['cpu_seconds'] = time.thread_time() - cpu_before
+            record['child_cpu_seconds'] = self.child_cpu_seconds() - child_cpu_before
+            record['rss_delta_bytes'] = self.rss_bytes() - rss_before
+            record['peak_rss_delta_bytes'] = self.peak_rss_bytes() - peak_before
+            http_after = self.http_counts()
+            record['http_requests'] = {counter: http_after[counter] - http_before.get(counter, 0) for counter in http_after}
+            if profiler is not None:
+                record['profile'] = self.write_profile(name, profiler)
+                if tracemalloc.is_tracing():
+                    snapshot = tracemalloc.take_snapshot()
+                    record['traced_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                    record['top_allocations'] = [{'location': str(stat.traceback), 'bytes': stat.size, 'count': stat.count} for stat in snapshot.statistics('lineno')[:10]]
+                if tracing:
+                    tracemalloc.stop()
+            stack.pop()
+            self.spans.append(record)
+
+    def write_profile(self, name, profiler) -> str:
+        # Write the cProfile stats of a stage to <name>.prof and return the path
+        profile_dir = self.profile_dir or '.'
+        os.makedirs(profile_dir, exist_ok=True)
+        path = os.path.join(profile_dir, f"{name.replace('/', '_')}.prof")
+        profiler.dump_stats(path)
+        return path
+
+    def wrap(self, target, method_names):
+        '''
+        This function replaces methods of an object with versions that run inside a span named after the method.
+        A method returning a DataFrame, list or dict records its length as the row count.
+
+        Parameters:
+        target (object): The object whose methods are instrumented.
+        method_names (list): Names of the methods to instrument.
+
+        Returns:
+        object: target, for chaining.
+        '''
+        for method_name in method_names:
+            method = getattr(target, method_name)
+
+            @functools.wraps(method)
+            def instrumented(*args, _method=method, _name=method_name, **kwargs):
+                with self.span(_name) as record:
+                    result = _method(*args, **kwargs)
+                    if record['rows'] is None and hasattr(result, '__len__') and not isinstance(result, str):
+                        record['rows'] = len(result)
+                    return result
+
+            setattr(target, method_name, instrumented)
+        return target
+
+    def report(self) -> dict:
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.started)),
+            'wall_seconds': time.time() - self.started,
+            'peak_rss_bytes': self.peak_rss_bytes(),
+            'spans': self.spans,
+        }
+
+    def to_prometheus(self, prefix='spotify_stats') -> str:
+        '''
+        This function renders the spans in the Prometheus text exposition format, one sample per stage and measure.
+        Stages that ran more than once are summed.
+        '''
+        totals = {}
+        for span in self.spans:
+            stage = totals.setdefault(span['name'], {'runs': 0, 'errors': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'child_cpu_seconds': 0.0, 'rss_delta_bytes': 0, 'peak_rss_delta_bytes': 0, 'rows': 0, 'http_requests': {}})
+            stage['runs'] += 1
+            stage['errors'] += int(span['status'] != 'ok')
+            for measure in ('wall_seconds', 'cpu_seconds', 'child_cpu_seconds', 'rss_delta_bytes', 'peak_rss_delta_bytes'):
+                stage[measure] += span[measure]
+            stage['rows'] += span['rows'] or 0
+            for counter, count in span['http_requests'].items():
+                stage['http_requests'][counter] = stage['http_requests'].get(counter, 0) + count
+
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        out = io.StringIO()
+        metrics = [
+            ('stage_runs_total', 'counter', 'Number of times the stage ran.', 'runs'),
+            ('stage_errors_total', 'counter', 'Number of stage runs that raised.', 'errors'),
+            ('stage_wall_seconds', 'gauge', 'Wall time spent in the stage.', 'wall_seconds'),
+            ('stage_cpu_seconds', 'gauge', 'CPU time of the thread running the stage.', 'cpu_seconds'),
+            ('stage_child_cpu_seconds', 'gauge', 'CPU time of child processes that finished during the stage.', 'child_cpu_seconds'),
+            ('stage_rss_delta_bytes', 'gauge', 'Change in resident memory over the stage.', 'rss_delta_bytes'),
+            ('stage_peak_rss_delta_bytes', 'gauge', 'Growth of the peak resident memory during the stage.', 'peak_rss_delta_bytes'),
+            ('stage_rows', 'gauge', 'Rows handled by the stage.', 'rows'),
+        ]
+        for metric, metric_type, help_text, measure in metrics:
+            out.write(f'# HELP {prefix}_{metric} {help_text}\n# TYPE {prefix}_{metric} {metric_type}\n')
+            for name, stage in totals.items():
+                out.write(f'{prefix}_{metric}{{stage="{label(name)}"}} {stage[measure]}\n')
+        out.write(f'# HELP {prefix}_stage_http_requests_total HTTP requests sent during the stage.\n# TYPE {prefix}_stage_http_requests_total counter\n')
+        for name, stage in totals.items():
+            for counter, count in stage['http_requests'].items():
+                out.write(f'{prefix}_stage_http_requests_total{{stage="{label(name)}",client="{label(counter)}"}} {count}\n')
+        out.write(f'# HELP {prefix}_peak_rss_bytes Peak resident memory of the run.\n# TYPE {prefix}_peak_rss_bytes gauge\n{prefix}_peak_rss_bytes {self.peak_rss_bytes()}\n')
+        return out.getvalue()
+
+    def write_report(self, path):
+        # Write the report atomically, in the Prometheus text format for a .prom path and as JSON otherwise
+        content = self.to_prometheus() if path.endswith('.prom') else json.dumps(self.report(), indent=2, default=str)
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            f.write(content)
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,276 @@
+import datetime
+import functools
+import numpy as np
+import pandas as pd
+from ArtistIndex import ArtistIndex
+
+class ListeningCube:
+    '''
+    Pre-aggregated ms_played sums and play counts grouped by local day, hour, artist and track.
+
+    The cube is built once at load time and every range statistic is answered from it
+    instead of the row level history. Days are stored as integer day numbers (days since
+    1970-01-01 in local time) and the cube is kept sorted on them, so a date range maps to
+    a contiguous block of rows. Dense prefix sums over every day between the first and the
+    last play make the total for any date range an O(1) lookup.
+    '''
+
+    KEYS = ['day', 'hour', 'artist', 'track']
+    VALUES = ['ms_played', 'plays']
+    KEY_DTYPES = {'day': 'int32', 'hour': 'int8', 'artist': 'category', 'track': 'category'}
+
+    def __init__(self, cube_df: pd.DataFrame):
+        # Narrow the key columns in memory, the repeated artist and track names are stored once as categories
+        self.cube_df = cube_df.sort_values('day', kind='stable').reset_index(drop=True).astype(self.KEY_DTYPES)
+        self.days = self.cube_df['day'].to_numpy()
+        self.artist_index = ArtistIndex(self.cube_df['artist'].cat.categories)
+
+        # Daily totals, then dense over every day from the first to the last listened day with a leading zero for the prefix sums
+        self.daily_ms_played = self.cube_df.groupby('day')['ms_played'].sum()
+        self.active_days = self.daily_ms_played.index.to_numpy()
+        self.first_day = int(self.active_days[0]) if len(self.active_days) else 0
+        dense = np.zeros(int(self.active_days[-1]) - self.first_day + 1 if len(self.active_days) else 0, dtype=np.int64)
+        dense[self.active_days - self.first_day] = self.daily_ms_played.to_numpy()
+        self.prefix_ms_played = np.concatenate(([0], np.cumsum(dense)))
+
+    @staticmethod
+    def to_day(value) -> int:
+        # Convert a date, datetime, Timestamp or date string to its integer day number
+        return int(pd.Timestamp(value).to_datetime64().astype('datetime64[D]').astype(np.int64))
+
+    @staticmethod
+    def build(df: pd.DataFrame) -> pd.DataFrame:
+        '''
+        This function aggregates the prepared streaming history into cube rows.
+
+        Parameters:
+        df (pd.DataFrame): The prepared streaming history with the integer 'day' and 'hour' keys.
+
+        Returns:
+        pd.DataFrame: One row per (day, hour, artist, track) with the summed 'ms_played' and the number of 'plays'.
+        '''
+        keys = pd.DataFrame({
+            'day': df['day'].to_numpy(),
+            'hour': df['hour'].to_numpy(),
+            # The artist and track keys stay categorical, every cube row holds two integer codes instead of two strings
+            'artist': df['master_metadata_album_artist_name'].astype('category').array,
+            'track': df['spotify_track_uri'].astype('category').array,
+            'ms_played': df['ms_played'].to_numpy().astype(np.int64),
+        })
+        # dropna=False keeps podcast and other rows without artist or track in the totals
+        cube_df = keys.groupby(ListeningCube.KEYS, dropna=False, sort=False, observed=True)['ms_played'].agg(['sum', 'count'])
+        cube_df.columns = ListeningCube.VALUES
+        return cube_df.reset_index()
+
+    @staticmethod
+    def merge(cube_df: pd.DataFrame, new_cube_df: pd.DataFrame) -> pd.DataFrame:
+        # new_cube_df may repeat keys, e.g. the concatenated cubes of several chunks. cube_df may be None for an empty cube.
+        from StreamingHistoryReader import concat_streaming_history
+
+        if cube_df is None:
+            cube_df = new_cube_df.iloc[:0]
+        # Only the cube rows on days touched by the new rows need to be regrouped
+        affected = cube_df['day'].isin(new_cube_df['day'].unique())
+        regrouped = concat_streaming_history([cube_df.loc[affected], new_cube_df])
+        regrouped = regrouped.groupby(ListeningCube.KEYS, dropna=False, sort=False, observed=True)[ListeningCube.VALUES].sum().reset_index()
+        merged = concat_streaming_history([cube_df.loc[~affected], regrouped])
+        for column in ('artist', 'track'):
+            merged[column] = merged[column].cat.remove_unused_categories()
+        return merged.sort_values('day', kind='stable').reset_index(drop=True)
+
+    def day_bounds(self, range_start=None, range_end=None):
+        # Integer day bounds of the range, the full cube when either end is missing
+        if range_start is None or range_end is None or not len(self.days):
+            return None, None
+        return self.to_day(range_start), self.to_day(range_end)
+
+    def slice(self, range_start=None, range_end=None) -> pd.DataFrame:
+        # Cube rows within the range, located by binary search on the sorted day column
+        start, end = self.day_bounds(range_start, range_end)
+        if start is None:
+            return self.cube_df
+        lo = np.searchsorted(self.days, start, side='left')
+        hi = np.searchsorted(self.days, end, side='right')
+        return self.cube_df.iloc[lo:hi]
+
+    def total(self, range_start=None, range_end=None) -> int:
+        # Total ms_played in the range from the prefix sums
+        start, end = self.day_bounds(range_start, range_end)
+        if start is None:
+            return int(self.prefix_ms_played[-1])
+        last = len(self.prefix_ms_played) - 1
+        lo = min(max(start - self.first_day, 0), last)
+        hi = min(max(end - self.first_day + 1, 0), last)
+        return int(self.prefix_ms_played[hi] - self.prefix_ms_played[lo]) if hi > lo else 0
+
+    def average(self, range_start=None, range_end=None) -> float:
+        # Average ms_played per day between the first and last listened day in the range
+        start, end = self.day_bounds(range_start, range_end)
+        active_days = self.active_days
+        if start is not None:
+            active_days = active_days[np.searchsorted(active_days, start, side='left'):np.searchsorted(active_days, end, side='right')]
+        if not len(active_days):
+            return 0.0
+        total_days = int(active_days[-1]) - int(active_days[0]) + 1
+        return float(self.total(range_start, range_end) / total_days)
+
+    def window(self, range_start=None, range_end=None) -> 'ListeningWindow':
+        # The cube rows within the range, wrapped so several statistics can share one slice
+        return ListeningWindow(self.slice(range_start, range_end), self.artist_index)
+
+    def hour_totals(self, range_start=None, range_end=None) -> dict:
+        return self.window(range_start, range_end).hour_totals()
+
+    def month_totals(self, year: int=None) -> dict:
+        # Sum the daily totals into months keyed on the month end date
+        if year is None:
+            return ListeningWindow.group_months(self.daily_ms_played)
+        return self.window(datetime.date(year, 1, 1), datetime.date(year, 12, 31)).month_totals()
+
+    def artist_total(self, artist_name, range_start=None, range_end=None) -> int:
+        return self.window(range_start, range_end).artist_total(artist_name)
+
+    def artist_totals(self, artist_names, range_start=None, range_end=None) -> dict:
+        return self.window(range_start, range_end).artist_totals(artist_names)
+
+    def top(self, key, limit=5, by='ms_played', range_start=None, range_end=None) -> list:
+        return self.window(range_start, range_end).top(key, limit, by)
+
+    def rolling_top(self, key, limit=5, by='ms_played', window_days=28, range_start=None, range_end=None) -> dict:
+        '''
+        This function ranks the top tracks or artists over a trailing window ending on each day of a range.
+        The per item totals are updated incrementally, adding the day entering the window and subtracting the day leaving it,
+        so each day costs one pass over its own cube rows plus a partial sort instead of a regroup of the whole window.
+
+        Parameters:
+        key (str): 'track' or 'artist'.
+        limit (int): Number of items to return per day.
+        by (str): 'ms_played' or 'plays', the value items are ranked on.
+        window_days (int): Length of the trailing window in days, including the day itself.
+        range_start (datetime.date): The first day to rank (inclusive). Defaults to the first listened day.
+        range_end (datetime.date): The last day to rank (inclusive). Defaults to the last listened day.
+
+        Returns:
+        dict: Lists of (name, value) tuples in descending order keyed on each datetime.date of the range.
+        '''
+        if not len(self.days):
+            return {}
+        start, end = self.day_bounds(range_start, range_end)
+        if start is None:
+            start, end = int(self.days[0]), int(self.days[-1])
+
+        categories = self.cube_df[key].cat.categories
+        codes = self.cube_df[key].cat.codes.to_numpy()
+        values = self.cube_df[by].to_numpy().astype(np.int64)
+        running = np.zeros(len(categories), dtype=np.int64)
+
+        def add_day(day, sign):
+            lo = np.searchsorted(self.days, day, side='left')
+            hi = np.searchsorted(self.days, day, side='right')
+            day_codes = codes[lo:hi]
+            known = day_codes >= 0
+            np.add.at(running, day_codes[known], sign * values[lo:hi][known])
+
+        results = {}
+        for day in range(start - window_days + 1, end + 1):
+            add_day(day, 1)
+            if day - window_days >= start - window_days + 1:
+                add_day(day - window_days, -1)
+            if day >= start:
+                date = datetime.date(1970, 1, 1) + datetime.timedelta(days=day)
+                results[date] = [(categories[code], int(running[code])) for code in ListeningWindow.top_codes(running, limit)]
+        return results
+
+
+class ListeningWindow:
+    '''
+    A slice of the listening cube for one date range.
+
+    Every derived grouping is computed on first use and kept, so any number of
+    statistics over the same range touch the cube rows only once per grouping.
+    '''
+
+    def __init__(self, cube_slice: pd.DataFrame, artist_index: ArtistIndex):
+        self.cube_slice = cube_slice
+        self.artist_index = artist_index
+        self._code_totals = {}
+
+    @functools.cached_property
+    def daily_ms_played(self) -> pd.Series:
+        return self.cube_slice.groupby('day')['ms_played'].sum()
+
+    @functools.cached_property
+    def hourly_ms_played(self) -> pd.Series:
+        return self.cube_slice.groupby('hour')['ms_played'].sum()
+
+    @functools.cached_property
+    def artist_ms_played(self) -> np.ndarray:
+        return self.code_totals('artist', 'ms_played')
+
+    def code_totals(self, key, by='ms_played') -> np.ndarray:
+        # Totals of by per category code of key in one pass over the slice, rows without a value (code -1) are left out
+        if (key, by) not in self._code_totals:
+            codes = self.cube_slice[key].cat.codes.to_numpy()
+            known = codes >= 0
+            totals = np.bincount(codes[known], weights=self.cube_slice[by].to_numpy()[known], minlength=len(self.cube_slice[key].cat.categories))
+            self._code_totals[(key, by)] = totals.astype(np.int64)
+        return self._code_totals[(key, by)]
+
+    @staticmethod
+    def top_codes(totals: np.ndarray, limit) -> np.ndarray:
+        # Codes of the largest non-zero totals in descending order, selected with a partial sort. Ties are broken on the code so results are deterministic.
+        limit = min(limit, int(np.count_nonzero(totals)))
+        if limit <= 0:
+            return np.zeros(0, dtype=np.int64)
+        threshold = totals[np.argpartition(-totals, limit - 1)[limit - 1]]
+        candidates = np.flatnonzero(totals >= threshold)
+        return candidates[np.argsort(-totals[candidates], kind='stable')][:limit]
+
+    def top(self, key, limit=5, by='ms_played') -> list:
+        '''
+        This function ranks the tracks or artists of the window.
+
+        Parameters:
+        key (str): 'track' or 'artist'.
+        limit (int): Number of items to return.
+        by (str): 'ms_played' or 'plays', the value items are ranked on.
+
+        Returns:
+        list: Dicts with the item name under key plus its 'ms_played' and 'plays', in descending order of by.
+        '''
+        categories = self.cube_slice[key].cat.categories
+        ms_played = self.code_totals(key, 'ms_played')
+        plays = self.code_totals(key, 'plays')
+        ranked = self.top_codes(ms_played if by == 'ms_played' else plays, limit)
+        return [{key: categories[code], 'ms_played': int(ms_played[code]), 'plays': int(plays[code])} for code in ranked]
+
+    @staticmethod
+    def group_months(daily_ms_played: pd.Series) -> dict:
+        # Sum daily totals keyed on integer day numbers into months keyed on the month end date, all on integer keys
+        months = daily_ms_played.index.to_numpy().astype('datetime64[D]').astype('datetime64[M]')
+        listening_month = pd.Series(daily_ms_played.to_numpy()).groupby(months.astype(np.int64)).sum()
+        month_ends = ((listening_month.index.to_numpy() + 1).astype('datetime64[M]').astype('datetime64[D]') - 1).astype(str)
+        return dict(zip(month_ends.tolist(), listening_month.tolist()))
+
+    def total(self) -> int:
+        return int(self.daily_ms_played.sum())
+
+    def average(self) -> float:
+        # Average ms_played per day between the first and last listened day in the window
+        if not len(self.daily_ms_played):
+            return 0.0
+        total_days = int(self.daily_ms_played.index[-1]) - int(self.daily_ms_played.index[0]) + 1
+        return float(self.total() / total_days)
+
+    def hour_totals(self) -> dict:
+        return self.hourly_ms_played.to_dict()
+
+    def month_totals(self) -> dict:
+        return self.group_months(self.daily_ms_played)
+
+    def artist_total(self, artist_name) -> int:
+        # Look the name up in the artist index and add up the per artist totals of the matches
+        return int(self.artist_ms_played[self.artist_index.match(artist_name)].sum())
+
+    def artist_totals(self, artist_names) -> dict:
+        return {artist_name: self.artist_total(artist_name) for artist_name in artist_names}
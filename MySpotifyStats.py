@@ -1,167 +1,246 @@
-import requests
+from __future__ import annotations
 import os
-import pytz
-import pandas as pd
-import base64
-from datetime import datetime, timedelta, timezone
-import configparser
-from typing import Union
-from Config import Config
-
-class MySpotifyStats:
-    client_id = None # Spotify API client ID
-    client_secret = None # Spotify API client secret
-    client_code = None # Spotify API client code
+import threading
+import contextlib
+from datetime import datetime, timedelta
+from typing import Union, TYPE_CHECKING
+from SpotifyApi import SpotifyApi
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+class MySpotifyStats(SpotifyApi):
     streaming_history_path = None # Path to the Spotify streaming history files 
-    redirect_uri = None # Spotify API redirect URI
 
 
-    def __init__(self):
-        self.CONFIG_FILE = 'config.ini' # Path to the config file. Config file should be in the same directory as this script.
-        self.config = Config(self.CONFIG_FILE)
+    def __init__(self, config_file='config.ini'):
+        super().__init__(config_file)
         self.setup()
         pass
 
     def setup(self):
-        # This function retrieves the Spotify API credentials from environment variables.
-        # Make sure to set these environment variables in your system or IDE.
-        self.client_id = self.config.get_config_value('Spotify_API_Secrets', 'SPOTIFY_CLIENT_ID') # os.getenv('SPOTIFY_CLIENT_ID')
-        self.client_secret = self.config.get_config_value('Spotify_API_Secrets', 'SPOTIFY_CLIENT_SECRET') # os.getenv('SPOTIFY_CLIENT_SECRET')
-        self.client_code = self.config.get_config_value('Spotify_API_Secrets', 'SPOTIFY_CLIENT_CODE') # os.getenv('SPOTIFY_CLIENT_CODE')
-        self.redirect_uri = self.config.get_config_value('Spotify_API_Secrets', 'SPOTIFY_REDIRECT_URI') # os.getenv('SPOTIFY_REDIRECT_URI')
+        # This function reads the streaming history settings. The history itself is loaded on first use by load().
+        # pandas and the history modules are imported there too, so API only callers never pay for them.
         self.streaming_history_path = self.config.get_config_value('Spotify_Data', 'SPOTIFY_STREAMING_HISTORY_PATH') # os.getenv('SPOTIFY_STREAMING_HISTORY_PATH')
 
-        if not self.client_id or not self.client_secret:
-            raise Exception("Please set the SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET environment variables.")
+        # Directory for the on-disk cache of the prepared streaming history
+        self.streaming_history_cache_path = self.config.get_config_value('Spotify_Data', 'SPOTIFY_STREAMING_HISTORY_CACHE_PATH', fallback='streaming_history_cache')
+
+        # Number of concurrent requests enrich_artists uses
+        self.api_workers = int(self.config.get_config_value('Spotify_API', 'SPOTIFY_API_WORKERS', fallback='8'))
+
+        # Low memory mode parses the export files in chunks and keeps only the listening cube in memory
+        self.streaming_history_low_memory = self.config.get_config_value('Spotify_Data', 'SPOTIFY_STREAMING_HISTORY_LOW_MEMORY', fallback='false').strip().lower() in ('1', 'true', 'yes', 'on')
+        self.streaming_history_chunk_size = int(self.config.get_config_value('Spotify_Data', 'SPOTIFY_STREAMING_HISTORY_CHUNK_SIZE', fallback='100000'))
 
+        # Number of worker processes parsing export files in parallel, defaults to one per CPU
+        self.streaming_history_workers = int(self.config.get_config_value('Spotify_Data', 'SPOTIFY_STREAMING_HISTORY_WORKERS', fallback=str(os.cpu_count() or 1)))
 
-        # get all files in directory like Streaming_History_Auddio in name
-        streaming_history_files = [f for f in os.listdir(self.streaming_history_path) if 'Streaming_History_Audio' in f]
+        # Timezone the local day and hour keys are computed in
+        self.timezone_name = self.config.get_config_value('Spotify_Data', 'SPOTIFY_TIMEZONE', fallback='America/Barbados')
+
+        self.loaded = False
+        self.load_lock = threading.Lock()
+        self.instrumentation = None # Instrumentation whose spans time the metrics of compute_stats, None to skip them
+        self._artist_enrichment = None
+
+    def load(self, rebuild=False):
+        '''
+        This function loads the streaming history, its listening cube and track table.
+        It runs on the first access to streaming_history_df, listening_cube, tracks_df or streaming_history_cache, so it only needs to be called directly to load eagerly or to rebuild.
         
-        # streaming history files list
-        self.streaming_history_files = [os.path.join(self.streaming_history_path, f) for f in streaming_history_files]
+        Parameters:
+        rebuild (bool): Ignore the stored history and parse every export file again.
+        
+        Returns:
+        None
+        '''
+        from StreamingHistoryCache import StreamingHistoryCache
+        from ListeningCube import ListeningCube
 
-        # stremaing history df
-        self.streaming_history_df = pd.concat([pd.read_json(f) for f in self.streaming_history_files], ignore_index=True)
+        with self.load_lock:
+            if self.loaded and not rebuild:
+                return
 
-        # Convert the 'ts' column to datetime and add 'ts_bb' column
-        self.streaming_history_df['ts'] = pd.to_datetime(self.streaming_history_df['ts'])
-        barbados_tz = pytz.timezone('America/Barbados')
-        self.streaming_history_df['ts_bb'] = self.streaming_history_df['ts'].dt.tz_convert(barbados_tz)
-        self.streaming_history_df['ts_day_bb'] = self.streaming_history_df['ts_bb'].dt.date 
+            # get all files in directory like Streaming_History_Auddio in name
+            streaming_history_files = sorted(f for f in os.listdir(self.streaming_history_path) if 'Streaming_History_Audio' in f)
+            
+            # streaming history files list
+            self.streaming_history_files = [os.path.join(self.streaming_history_path, f) for f in streaming_history_files]
+
+            # stremaing history df and the listening cube the range statistics are answered from
+            self._streaming_history_cache = StreamingHistoryCache(self.streaming_history_cache_path, settings={'mode': 'low_memory' if self.streaming_history_low_memory else 'full', 'timezone': self.timezone_name})
+            # hold the store lock from the refresh to the last read, so another process can not change the store in between
+            with self._streaming_history_cache.file_lock():
+                streaming_history_df, cube_df = self.load_streaming_history(rebuild)
+                tracks_df = self._streaming_history_cache.load_tracks()
+            self._streaming_history_df = self.index_streaming_history(streaming_history_df) if streaming_history_df is not None else None
+            self._listening_cube = ListeningCube(cube_df)
+            self._tracks_df = tracks_df.set_index('spotify_track_uri')
+            self.loaded = True
+
+    def reload(self):
+        '''
+        This function loads the streaming history again to pick up export files added or changed since the last load.
+        Only those files are parsed, the rest is read back from the on-disk store.
 
-    
+        Returns:
+        None
+        '''
+        with self.load_lock:
+            self.loaded = False
+        self.load()
+
+    @property
+    def streaming_history_df(self) -> pd.DataFrame:
+        self.load()
+        return self._streaming_history_df
+
+    @property
+    def listening_cube(self):
+        self.load()
+        return self._listening_cube
+
+    @property
+    def tracks_df(self) -> pd.DataFrame:
+        self.load()
+        return self._tracks_df
+
+    @property
+    def streaming_history_cache(self):
+        self.load()
+        return self._streaming_history_cache
+
+    @property
+    def artist_enrichment(self):
+        # Local table of Spotify artist details, filled by enrich_artists
+        if self._artist_enrichment is None:
+            from ArtistEnrichment import ArtistEnrichment
+            self._artist_enrichment = ArtistEnrichment(self, os.path.join(self.streaming_history_cache_path, 'artists.parquet'), self.api_workers)
+        return self._artist_enrichment
+
+    def load_streaming_history(self, rebuild=False):
+        '''
+        This function returns the prepared streaming history DataFrame and its listening cube rows.
+        Files that were already ingested are read back from the on-disk store, only new or changed export files are parsed.
+        In low memory mode the history is left on disk and None is returned in its place.
+        
+        Parameters:
+        rebuild (bool): Ignore the stored history and parse every export file again.
 
-    def get_top_item(self, token, content_type, time_range='short_term', limit=5):
-        # This function retrieves the user's top tracks from Spotify.
-        url = f"https://api.spotify.com/v1/me/top/{content_type}?time_range={time_range}&limit={limit}"
-        headers = {
-            "Authorization": f"Bearer {token}",
-        }
+        Returns:
+        tuple: (pd.DataFrame, pd.DataFrame) The streaming history with 'ts' parsed and the 'day' and 'hour' keys added, and the cube rows described in ListeningCube.build.
+        '''
+        cube_df = self._streaming_history_cache.refresh(self.streaming_history_files, self.read_streaming_history_files, rebuild=rebuild)
+        if self.streaming_history_low_memory:
+            return None, cube_df
+        return self._streaming_history_cache.load_history(), cube_df
+
+    def read_streaming_history_files(self, files):
+        # Parse raw export files into prepared DataFrame chunks, file by file in order
+        from StreamingHistoryReader import iter_streaming_history_files
+        return iter_streaming_history_files(files, self.timezone_name, workers=self.streaming_history_workers, low_memory=self.streaming_history_low_memory, chunk_size=self.streaming_history_chunk_size)
+
+    def index_streaming_history(self, streaming_history_df: pd.DataFrame) -> pd.DataFrame:
+        # Sort the history by timestamp and index it on the local time so date ranges become binary search slices
+        import pandas as pd
+        streaming_history_df = streaming_history_df.sort_values('ts', kind='stable')
+        return streaming_history_df.set_axis(pd.DatetimeIndex(streaming_history_df['ts']).tz_convert(self.timezone_name).rename(None), axis=0)
+
+    def get_streaming_history(self, range_start: Union[str, datetime.date, pd.Timestamp]=None, range_end: Union[str, datetime.date, pd.Timestamp]=None) -> pd.DataFrame:
+        '''
+        This function returns the streaming history rows listened to within a specified date range.
+        The rows are located by binary search on the sorted time index and returned as a slice, not a copy, so callers must not modify it.
+        In low memory mode only the rows in the range are read from the on-disk store.
+        
+        Parameters:
+        range_start (datetime.date): The start date of the range (inclusive).
+        range_end (datetime.date): The end date of the range (inclusive).
+        
+        Returns:
+        pd.DataFrame: The streaming history rows within the range, or the full history when either end is missing.
+        '''
+        import pandas as pd
+        start = end = None
+        if range_start is not None and range_end is not None:
+            start = pd.Timestamp(pd.Timestamp(range_start).date()).tz_localize(self.timezone_name)
+            end = pd.Timestamp(pd.Timestamp(range_end).date() + timedelta(days=1)).tz_localize(self.timezone_name)
+
+        if self.streaming_history_df is None:
+            streaming_history_df = self.streaming_history_cache.load_history(start, end)
+            if streaming_history_df is None:
+                return None
+            streaming_history_df = self.index_streaming_history(streaming_history_df)
+            # The store filter is inclusive at the end, drop rows exactly at the next midnight
+            return streaming_history_df if end is None else streaming_history_df.loc[streaming_history_df['ts'] < end]
+
+        if start is None:
+            return self.streaming_history_df
 
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            return response.json().get("items")
-        else:
-            raise Exception("Failed to retrieve top tracks. Check your token and permissions.")
+        index = self.streaming_history_df.index
+        return self.streaming_history_df.iloc[index.searchsorted(start, side='left'):index.searchsorted(end, side='left')]
+
+    def get_memory_footprint(self) -> dict:
+        '''
+        This function reports how much memory the loaded streaming history and listening cube hold.
         
-    def get_top_tracks(self, token, time_range='short_term', limit=5):
-        # This function retrieves the user's top tracks from Spotify.
-        return self.get_top_item(token, 'tracks', time_range, limit)
+        Returns:
+        dict: 'streaming_history' and 'listening_cube' dicts of bytes per column plus a 'total', and the overall 'total' in bytes. 'streaming_history' is None in low memory mode.
+        '''
+        from StreamingHistoryReader import memory_footprint
+        streaming_history = memory_footprint(self.streaming_history_df) if self.streaming_history_df is not None else None
+        listening_cube = memory_footprint(self.listening_cube.cube_df)
+        return {
+            'streaming_history': streaming_history,
+            'listening_cube': listening_cube,
+            'total': (streaming_history['total'] if streaming_history else 0) + listening_cube['total'],
+        }
     
-    def get_top_artists(self, token, time_range='short_term', limit=5):
-        # This function retrieves the user's top artists from Spotify.
-        return self.get_top_item(token, 'artists', time_range, limit)
 
-    
-    def spotify_artist_search(self, token, artist_name):
+    def enrich_artists(self, token, artist_names=None, refresh=False) -> dict:
         '''
-        This function searches for an artist on Spotify by name.
-        It returns the first artist object found.
+        This function fetches the Spotify details (genres, popularity, followers, images) of the artists in the streaming history.
+        Names are resolved to artist IDs and the artists are fetched 50 at a time with concurrent requests. Artists already in the table are skipped.
         
         Parameters:
         token (str): The Spotify API token.
-        artist_name (str): The name of the artist to search for.
+        artist_names (list): The artist names to enrich. Defaults to every artist in the streaming history.
+        refresh (bool): Look every artist up again.
         
         Returns:
-        dict: The first artist object found in the search results. Object contains the artist's name, id, images genres, uri etc. Reference https://developer.spotify.com/documentation/web-api/reference/search
-        
-        
+        dict: The number of 'added' artists, the 'not_found' names and the 'failed' names with their error messages.
         '''
+        if artist_names is None:
+            artist_names = list(self.listening_cube.artist_index.artist_names)
+        return self.artist_enrichment.enrich(token, artist_names, refresh)
 
-        # This function searches for an artist on Spotify by name.
-        url = f"https://api.spotify.com/v1/search?q={artist_name}&type=artist&limit=1"
-        headers = {
-            "Authorization": f"Bearer {token}",
-        }
-
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            artist_obj = response.json().get("artists", {}).get("items", [])
-        else:
-            raise Exception("Failed to search for artist. Check your token and permissions.")
+    def get_artist_table(self) -> pd.DataFrame:
+        '''
+        This function returns the enriched artist table.
+        It has the fields of simplify_top_artists and joins onto the streaming history on 'master_metadata_album_artist_name'.
         
-        return artist_obj[0] if artist_obj else None
+        Returns:
+        pd.DataFrame: One row per enriched artist name.
+        '''
+        return self.artist_enrichment.load()
 
         
 
     def get_total_listening(self, range_start: Union[str, datetime.date, pd.Timestamp]=None, range_end: Union[str, datetime.date, pd.Timestamp]=None) -> int:
-        # Work on a copy of the DataFrame to avoid modifying the original
-        df_copy = self.streaming_history_df.copy()
-
-        if range_start is not None and range_end is not None:
-            # Filter the DataFrame for the specified date range
-            mask = (df_copy['ts_day_bb'] >= range_start) & (df_copy['ts_day_bb'] <= range_end)
-            df_copy = df_copy.loc[mask]
-
-        total_listening_ms = df_copy['ms_played'].sum()
-        return int(total_listening_ms)
+        # Answered from the prefix sums of the listening cube
+        return self.listening_cube.total(range_start, range_end)
     
     def get_total_listening_by_month(self, year: int=None) -> dict:
-        # Work on a copy of the DataFrame to avoid modifying the original
-        df_copy = self.streaming_history_df.copy()
-
-        if year is not None:
-            # Filter the DataFrame for the specified yea
-            df_copy = df_copy[df_copy['ts_bb'].dt.year == year]
-
-        # Create column for end of month of date
-        df_copy['end_of_month'] = df_copy['ts_bb'].dt.date + pd.offsets.MonthEnd(0)
-
-        # Group by end of month and sum the ms_played column
-        listening_month_df = df_copy.groupby(['end_of_month'])['ms_played'].sum()
-        listening_month_df.index = listening_month_df.index.astype(str)  # Convert the index to string format
-        return listening_month_df.to_dict()
+        # Group the cube's daily totals by end of month
+        return self.listening_cube.month_totals(year)
 
     def get_average_listening(self, range_start: Union[str, datetime.date, pd.Timestamp]=None, range_end: Union[str, datetime.date, pd.Timestamp]=None) -> float:
-        # Work on a copy of the DataFrame to avoid modifying the original
-        df_copy = self.streaming_history_df.copy()
-
-        if range_start is not None and range_end is not None:
-            # Filter the DataFrame for the specified date range
-            mask = (df_copy['ts_day_bb'] >= range_start) & (df_copy['ts_day_bb'] <= range_end)
-            df_copy = df_copy.loc[mask]
-
-        total_listening_ms = df_copy['ms_played'].sum()
-        total_days = (df_copy['ts_day_bb'].max() - df_copy['ts_day_bb'].min()).days + 1
-        average_listening_ms = total_listening_ms / total_days if total_days > 0 else 0
-        return float(average_listening_ms)
+        # Total listening divided by the days between the first and last listened day in the range
+        return self.listening_cube.average(range_start, range_end)
 
     def get_hour_listened(self, range_start: Union[str, datetime.date, pd.Timestamp]=None, range_end: Union[str, datetime.date, pd.Timestamp]=None):
-        # Work on a copy of the DataFrame to avoid modifying the original
-        df_copy = self.streaming_history_df.copy()
-
-        if range_start is not None and range_end is not None:
-            # Filter the DataFrame for the specified date range
-            mask = (df_copy['ts_day_bb'] >= range_start) & (df_copy['ts_day_bb'] <= range_end)
-            df_copy = df_copy.loc[mask]
-
-        # Create a new column for the hour of the day
-        df_copy['hour'] = df_copy['ts_bb'].dt.hour
-
-        # Group by hour and sum the ms_played column
-        listening_hour_df = df_copy.groupby(['hour'])['ms_played'].sum()
-        return listening_hour_df.to_dict()
+        # Group the cube rows within the range by hour of the day
+        return self.listening_cube.hour_totals(range_start, range_end)
     
 
     def get_artist_listening_time(self, artist_name, range_start: Union[str, datetime.date, pd.Timestamp]=None, range_end: Union[str, datetime.date, pd.Timestamp]=None) -> int:
@@ -176,116 +255,151 @@ class MySpotifyStats:
         Returns:
         int: The total listening time in milliseconds for the specified artist within the date range.
         '''
-        
-        # Work on a copy of the DataFrame to avoid modifying the original
-        df_copy = self.streaming_history_df.copy()
-
-        if range_start is not None and range_end is not None:
-            # Filter the DataFrame for the specified date range
-            mask = (df_copy['ts_day_bb'] >= range_start) & (df_copy['ts_day_bb'] <= range_end)
-            df_copy = df_copy.loc[mask]
-
-        # Filter the DataFrame for the specified artist
-        mask = df_copy['master_metadata_album_artist_name'].str.match(artist_name, case=False, na=False)
-        df_artist = df_copy.loc[mask]
+        return self.listening_cube.artist_total(artist_name, range_start, range_end)
 
-        # Calculate total listening time in minutes
-        total_listening_ms = df_artist['ms_played'].sum()
+    def get_artists_listening_time(self, artist_names, range_start: Union[str, datetime.date, pd.Timestamp]=None, range_end: Union[str, datetime.date, pd.Timestamp]=None, ranges=None) -> dict:
+        '''
+        This function retrieves the total listening time for many artists, over one date range or over many date ranges, in a single call.
+        Each range is summed per artist once and every name is then answered from the artist index, so the cost does not grow with artists times rows.
         
-        return total_listening_ms
-    
+        Parameters:
+        artist_names (list): The names of the artists, matched the same way as in get_artist_listening_time.
+        range_start (datetime.date): The start date of the range (inclusive). Ignored when ranges is given.
+        range_end (datetime.date): The end date of the range (inclusive). Ignored when ranges is given.
+        ranges (list): Optional (range_start, range_end) tuples to compute the totals for.
+        
+        Returns:
+        dict: Listening time in milliseconds keyed on artist name, or when ranges is given a dict of those keyed on each (range_start, range_end) tuple.
+        '''
+        if ranges is None:
+            return self.listening_cube.artist_totals(artist_names, range_start, range_end)
+        return {(start, end): self.listening_cube.artist_totals(artist_names, start, end) for start, end in ranges}
+
+
+    def local_track_object(self, track_uri, ms_played=None, plays=None) -> dict:
+        # Shape a track from the history like a Spotify track object, filling only the fields the export provides
+        track_id = track_uri.split(':')[-1]
+        track = self.tracks_df.loc[track_uri] if track_uri in self.tracks_df.index else None
+        return {
+            'name': track['master_metadata_track_name'] if track is not None else None,
+            'id': track_id,
+            'uri': track_uri,
+            'artists': [{'name': track['master_metadata_album_artist_name']}] if track is not None else [],
+            'album': {'name': track['master_metadata_album_album_name'] if track is not None else None, 'images': [], 'release_date': None},
+            'external_urls': {'spotify': f"https://open.spotify.com/track/{track_id}"},
+            'ms_played': ms_played,
+            'plays': plays,
+        }
 
-    def btoa(self,string):
-        return base64.b64encode(string.encode('utf-8')).decode('utf-8')
-    
+    def local_artist_object(self, artist_name, ms_played=None, plays=None) -> dict:
+        # Shape an artist from the history like a Spotify artist object, the export only provides the name
+        return {
+            'name': artist_name,
+            'id': None,
+            'external_urls': {'spotify': None},
+            'genres': [],
+            'popularity': None,
+            'followers': {'total': None},
+            'images': [],
+            'ms_played': ms_played,
+            'plays': plays,
+        }
 
+    def get_local_top_item(self, content_type, range_start: Union[str, datetime.date, pd.Timestamp]=None, range_end: Union[str, datetime.date, pd.Timestamp]=None, limit=5, by='ms_played') -> list:
+        '''
+        This function ranks the user's top tracks or artists from the streaming history over any date range.
+        Unlike get_top_item it needs no network call and is not limited to Spotify's three time_range buckets.
+        
+        Parameters:
+        content_type (str): 'tracks' or 'artists'.
+        range_start (datetime.date): The start date of the range (inclusive).
+        range_end (datetime.date): The end date of the range (inclusive).
+        limit (int): Number of items to return.
+        by (str): 'ms_played' to rank on listening time or 'plays' to rank on play count.
+        
+        Returns:
+        list: Track or artist objects shaped like the Spotify API ones, so they can be passed to simplify_top_songs and simplify_top_artists, with 'ms_played' and 'plays' added.
+        '''
+        if by not in ('ms_played', 'plays'):
+            raise Exception("by must be either 'ms_played' or 'plays'.")
+        if content_type == 'tracks':
+            return [self.local_track_object(item['track'], item['ms_played'], item['plays']) for item in self.listening_cube.top('track', limit, by, range_start, range_end)]
+        if content_type == 'artists':
+            return [self.local_artist_object(item['artist'], item['ms_played'], item['plays']) for item in self.listening_cube.top('artist', limit, by, range_start, range_end)]
+        raise Exception("content_type must be either 'tracks' or 'artists'.")
+
+    def get_local_top_tracks(self, range_start: Union[str, datetime.date, pd.Timestamp]=None, range_end: Union[str, datetime.date, pd.Timestamp]=None, limit=5, by='ms_played') -> list:
+        # This function ranks the user's top tracks from the streaming history.
+        return self.get_local_top_item('tracks', range_start, range_end, limit, by)
+
+    def get_local_top_artists(self, range_start: Union[str, datetime.date, pd.Timestamp]=None, range_end: Union[str, datetime.date, pd.Timestamp]=None, limit=5, by='ms_played') -> list:
+        # This function ranks the user's top artists from the streaming history.
+        return self.get_local_top_item('artists', range_start, range_end, limit, by)
+
+    def get_rolling_top_item(self, content_type, range_start: Union[str, datetime.date, pd.Timestamp]=None, range_end: Union[str, datetime.date, pd.Timestamp]=None, limit=5, by='ms_played', window_days=28) -> dict:
+        '''
+        This function ranks the user's top tracks or artists over a trailing window for each day of a date range, e.g. the trailing 28 days.
+        
+        Parameters:
+        content_type (str): 'tracks' or 'artists'.
+        range_start (datetime.date): The first day to rank (inclusive).
+        range_end (datetime.date): The last day to rank (inclusive).
+        limit (int): Number of items to return per day.
+        by (str): 'ms_played' to rank on listening time or 'plays' to rank on play count.
+        window_days (int): Length of the trailing window in days, including the day itself.
+        
+        Returns:
+        dict: Lists of Spotify shaped track or artist objects keyed on each datetime.date, with only the ranked value (ms_played or plays) filled in.
+        '''
+        if by not in ('ms_played', 'plays'):
+            raise Exception("by must be either 'ms_played' or 'plays'.")
+        if content_type not in ('tracks', 'artists'):
+            raise Exception("content_type must be either 'tracks' or 'artists'.")
 
-    def get_access_token(self):
-        expiration = self.config.get_config_value('Spotify_API', 'SPOTIFY_ACCESS_TOKEN_EXPIRATION') 
-        # check if the expiration time is set and if it is in the past
-        if expiration:
-            expiration = datetime.fromisoformat(expiration).astimezone(timezone.utc)
-            if expiration > datetime.now(timezone.utc):
-                # If the token is still valid, return it
-                return self.config.get_config_value('Spotify_API', 'SPOTIFY_ACCESS_TOKEN')
-            else:
-                return self.refresh_spotify_api_token()
+        key = 'track' if content_type == 'tracks' else 'artist'
+        shape = self.local_track_object if content_type == 'tracks' else self.local_artist_object
+        rolling = self.listening_cube.rolling_top(key, limit, by, window_days, range_start, range_end)
+        return {day: [shape(name, **{by: value}) for name, value in items] for day, items in rolling.items()}
 
-        else:
-            # If the token is not set, generate a new one
-            return self.generate_spotify_api_token()
+    def compute_stats(self, metric_specs) -> dict:
+        '''
+        This function computes many statistics in one pass, sharing the date range slices and groupings between them.
+        Specs over the same date range are answered from a single slice of the listening cube, and each grouping (by day, by hour, by artist) is computed at most once per range.
         
-    def set_token_info(self, access_token, refresh_token, expires_in):
-        print(f"Access Token: {access_token}")
-        print(f"Refresh Token: {refresh_token}")
-        print(f"Expires In: {expires_in} seconds")
-        # This function sets the access token, refresh token, and expiration time in environment variables.
-        self.config.set_config_value('Spotify_API', 'SPOTIFY_ACCESS_TOKEN', access_token)
-        self.config.set_config_value('Spotify_API', 'SPOTIFY_REFRESH_TOKEN', refresh_token)
-        self.config.set_config_value('Spotify_API', 'SPOTIFY_ACCESS_TOKEN_EXPIRATION', (datetime.now(timezone.utc) + timedelta(seconds=expires_in)).isoformat())  
-
-
-    def generate_spotify_api_token(self):
-        # This function generates a Spotify API token using the client credentials flow.
-        url = "https://accounts.spotify.com/api/token"
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Authorization": f"Basic {self.btoa(self.client_id + ':' + self.client_secret)}"  ,
-        }
-        data = {
-            "code": self.client_code,
-            "redirect_uri": self.redirect_uri,  # Replace with your redirect URI
-            "grant_type": "authorization_code",
-        }
-
-        response = requests.post(url, headers=headers, data=data)
-        if response.status_code == 200:
-            response_json = response.json() # .get("access_token")
-            access_token = response_json.get("access_token")
-            refresh_token = response_json.get("refresh_token")
-            expires_in = response_json.get("expires_in") # in seconds
-            
-            # Set the access token, refresh token, and expiration time in environment variables
-            self.set_token_info(access_token, refresh_token, expires_in)
-            return access_token
-
-        else:
-            print(f"Response: {response.json()}")
-            raise Exception("Failed to generate Spotify API token. Check your credentials.")
-
-
-    def refresh_spotify_api_token(self):
-        refresh_token = self.config.get_config_value('Spotify_API', 'SPOTIFY_REFRESH_TOKEN') 
-        if not refresh_token:
-            raise Exception("Refresh token is not set. Please generate a new access token.")
-        # This function refreshes the Spotify API token using the refresh token.
-        url = "https://accounts.spotify.com/api/token"
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Authorization": f"Basic {self.btoa(self.client_id + ':' + self.client_secret)}",
-        }
-        data = {
-            "refresh_token": refresh_token,
-            "grant_type": "refresh_token",
+        Parameters:
+        metric_specs (list): Dicts with a 'name' for the result and a 'metric', one of 'total', 'average', 'month', 'hour' or 'artist'.
+        'total', 'average', 'hour' and 'artist' take optional 'range_start' and 'range_end', 'month' takes an optional 'year' and 'artist' requires 'artist_name'.
+        
+        Returns:
+        dict: The result of each spec keyed on its name, matching the return value of the corresponding get_* method.
+        '''
+        metric_functions = {
+            'total': lambda window, spec: window.total(),
+            'average': lambda window, spec: window.average(),
+            'month': lambda window, spec: window.month_totals(),
+            'hour': lambda window, spec: window.hour_totals(),
+            'artist': lambda window, spec: window.artist_total(spec['artist_name']),
         }
 
-        response = requests.post(url, headers=headers, data=data)
-        if response.status_code == 200:
-            response_json = response.json() # .get("access_token")
-            access_token = response_json.get("access_token")
-            refresh_token = response_json.get("refresh_token")
-            expires_in = response_json.get("expires_in") # in seconds
-            
-            # There are instances depending on the grant type where the refresh token is not returned in the response and the access token is returned instead.
-            # In this case, the script can use the previously stored access token
-            if refresh_token is None and access_token is not None:
-                update_expiration = self.config.set_config_value('Spotify_API', 'SPOTIFY_ACCESS_TOKEN_EXPIRATION', (datetime.now(timezone.utc) + timedelta(seconds=expires_in)).isoformat())
-                return access_token
+        # Plan: group the specs by the date range they cover
+        planned = {}
+        for spec in metric_specs:
+            if spec['metric'] not in metric_functions:
+                raise Exception(f"Unknown metric '{spec['metric']}'. Expected one of {', '.join(metric_functions)}.")
+            if spec['metric'] == 'month' and spec.get('year') is not None:
+                bounds = (datetime(spec['year'], 1, 1).date(), datetime(spec['year'], 12, 31).date())
+            elif spec['metric'] != 'month':
+                bounds = (spec.get('range_start'), spec.get('range_end'))
             else:
-                # Set the access token, refresh token, and expiration time in environment variables
-                self.set_token_info(access_token, refresh_token, expires_in)
-                return access_token
-        else:
-            raise Exception("Failed to refresh Spotify API token. Check your credentials.")
-
-
+                bounds = (None, None)
+            key = self.listening_cube.day_bounds(*bounds)
+            planned.setdefault(key, (bounds, []))[1].append(spec)
+
+        # Execute: slice the cube once per range and answer every spec from that slice
+        results = {}
+        for bounds, specs in planned.values():
+            window = self.listening_cube.window(*bounds)
+            for spec in specs:
+                with (self.instrumentation.span(f"compute_stats/{spec['name']}") if self.instrumentation else contextlib.nullcontext()):
+                    results[spec['name']] = metric_functions[spec['metric']](window, spec)
+        return results
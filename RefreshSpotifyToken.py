@@ -0,0 +1,6 @@
+from SpotifyApi import SpotifyApi
+
+# refresh the Spotify API token if it expired, without loading the streaming history
+# the token is stored in config.ini, so later runs reuse it until it expires
+spotify_api = SpotifyApi('config.ini')
+token = spotify_api.get_access_token()
@@ -0,0 +1,226 @@
+import base64
+import hashlib
+from datetime import datetime, timedelta, timezone
+from Config import Config
+from SpotifyApiClient import SpotifyApiClient
+from SpotifyResponseCache import SpotifyResponseCache
+
+class SpotifyApi:
+    '''
+    Spotify Web API access: the token flow, top tracks and artists and the artist search.
+
+    It only needs config.ini and none of the streaming history, so importing and
+    constructing it stays fast. Scripts that only refresh the token or read the top
+    items can use it directly; MySpotifyStats extends it with the history statistics.
+    '''
+    client_id = None # Spotify API client ID
+    client_secret = None # Spotify API client secret
+    client_code = None # Spotify API client code
+    redirect_uri = None # Spotify API redirect URI
+
+
+    def __init__(self, config_file='config.ini'):
+        self.CONFIG_FILE = config_file # Path to the config file. Config file should be in the same directory as this script.
+        self.config = Config(self.CONFIG_FILE)
+        self.setup_api()
+
+    def setup_api(self):
+        # This function retrieves the Spotify API credentials from environment variables.
+        # Make sure to set these environment variables in your system or IDE.
+        self.client_id = self.config.get_config_value('Spotify_API_Secrets', 'SPOTIFY_CLIENT_ID') # os.getenv('SPOTIFY_CLIENT_ID')
+        self.client_secret = self.config.get_config_value('Spotify_API_Secrets', 'SPOTIFY_CLIENT_SECRET') # os.getenv('SPOTIFY_CLIENT_SECRET')
+        self.client_code = self.config.get_config_value('Spotify_API_Secrets', 'SPOTIFY_CLIENT_CODE') # os.getenv('SPOTIFY_CLIENT_CODE')
+        self.redirect_uri = self.config.get_config_value('Spotify_API_Secrets', 'SPOTIFY_REDIRECT_URI') # os.getenv('SPOTIFY_REDIRECT_URI')
+
+        if not self.client_id or not self.client_secret:
+            raise Exception("Please set the SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET environment variables.")
+
+        # Shared Spotify API client with connection pooling, timeouts and retries on rate limiting
+        self.api_client = SpotifyApiClient(
+            timeout=float(self.config.get_config_value('Spotify_API', 'SPOTIFY_API_TIMEOUT', fallback='30')),
+            max_retries=int(self.config.get_config_value('Spotify_API', 'SPOTIFY_API_MAX_RETRIES', fallback='5')),
+        )
+
+        # Cache of Spotify API responses, kept in a SQLite file between runs when a path is set
+        self.api_cache = SpotifyResponseCache(
+            ttls={
+                'search_artist': int(self.config.get_config_value('Spotify_API', 'SPOTIFY_API_CACHE_TTL_SEARCH', fallback=str(7 * 24 * 3600))),
+                'top_items': int(self.config.get_config_value('Spotify_API', 'SPOTIFY_API_CACHE_TTL_TOP', fallback='3600')),
+            },
+            max_entries=int(self.config.get_config_value('Spotify_API', 'SPOTIFY_API_CACHE_SIZE', fallback='10000')),
+            cache_file=self.config.get_config_value('Spotify_API', 'SPOTIFY_API_CACHE_PATH', fallback=None) or None,
+        )
+
+
+    def cache_user(self) -> str:
+        # Short hash of the refresh token identifying the user in the response cache keys
+        refresh_token = self.config.get_config_value('Spotify_API', 'SPOTIFY_REFRESH_TOKEN', fallback='') or ''
+        return hashlib.sha256(refresh_token.encode('utf-8')).hexdigest()[:16]
+
+    def get_top_item(self, token, content_type, time_range='short_term', limit=5):
+        # This function retrieves the user's top tracks from Spotify.
+        # The access token is left out of the cache key since it changes on every refresh while the user stays the same.
+        # The user is told apart by a hash of their refresh token, so users sharing a cache file never see each other's items.
+        cache_key = f"{self.cache_user()}:{content_type}:{time_range}:{limit}"
+        items = self.api_cache.get('top_items', cache_key)
+        if items is not SpotifyResponseCache.MISS:
+            return items
+
+        url = f"https://api.spotify.com/v1/me/top/{content_type}"
+        headers = {
+            "Authorization": f"Bearer {token}",
+        }
+
+        response = self.api_client.get(url, headers=headers, params={'time_range': time_range, 'limit': limit})
+        if response.status_code == 200:
+            items = response.json().get("items")
+            self.api_cache.set('top_items', cache_key, items)
+            return items
+        else:
+            raise Exception("Failed to retrieve top tracks. Check your token and permissions.")
+        
+    def get_top_tracks(self, token, time_range='short_term', limit=5):
+        # This function retrieves the user's top tracks from Spotify.
+        return self.get_top_item(token, 'tracks', time_range, limit)
+    
+    def get_top_artists(self, token, time_range='short_term', limit=5):
+        # This function retrieves the user's top artists from Spotify.
+        return self.get_top_item(token, 'artists', time_range, limit)
+
+    
+    def spotify_artist_search(self, token, artist_name):
+        '''
+        This function searches for an artist on Spotify by name.
+        It returns the first artist object found.
+        
+        Parameters:
+        token (str): The Spotify API token.
+        artist_name (str): The name of the artist to search for.
+        
+        Returns:
+        dict: The first artist object found in the search results. Object contains the artist's name, id, images genres, uri etc. Reference https://developer.spotify.com/documentation/web-api/reference/search
+        
+        
+        '''
+
+        # This function searches for an artist on Spotify by name.
+        # Results, including not found, are cached on the normalised name
+        cache_key = SpotifyResponseCache.normalise(artist_name)
+        artist = self.api_cache.get('search_artist', cache_key)
+        if artist is not SpotifyResponseCache.MISS:
+            return artist
+
+        url = "https://api.spotify.com/v1/search"
+        headers = {
+            "Authorization": f"Bearer {token}",
+        }
+
+        response = self.api_client.get(url, headers=headers, params={'q': artist_name, 'type': 'artist', 'limit': 1})
+        if response.status_code == 200:
+            artist_obj = response.json().get("artists", {}).get("items", [])
+        else:
+            raise Exception("Failed to search for artist. Check your token and permissions.")
+        
+        artist = artist_obj[0] if artist_obj else None
+        self.api_cache.set('search_artist', cache_key, artist)
+        return artist
+
+
+    def btoa(self,string):
+        return base64.b64encode(string.encode('utf-8')).decode('utf-8')
+    
+
+
+    def get_access_token(self):
+        expiration = self.config.get_config_value('Spotify_API', 'SPOTIFY_ACCESS_TOKEN_EXPIRATION') 
+        # check if the expiration time is set and if it is in the past
+        if expiration:
+            expiration = datetime.fromisoformat(expiration).astimezone(timezone.utc)
+            if expiration > datetime.now(timezone.utc):
+                # If the token is still valid, return it
+                return self.config.get_config_value('Spotify_API', 'SPOTIFY_ACCESS_TOKEN')
+            else:
+                return self.refresh_spotify_api_token()
+
+        else:
+            # If the token is not set, generate a new one
+            return self.generate_spotify_api_token()
+        
+    def set_token_info(self, access_token, refresh_token, expires_in):
+        print(f"Access Token: {access_token}")
+        print(f"Refresh Token: {refresh_token}")
+        print(f"Expires In: {expires_in} seconds")
+        # This function sets the access token, refresh token, and expiration time in the config file, written together in one atomic update.
+        with self.config.batch():
+            self.config.set_config_value('Spotify_API', 'SPOTIFY_ACCESS_TOKEN', access_token)
+            self.config.set_config_value('Spotify_API', 'SPOTIFY_REFRESH_TOKEN', refresh_token)
+            self.config.set_config_value('Spotify_API', 'SPOTIFY_ACCESS_TOKEN_EXPIRATION', (datetime.now(timezone.utc) + timedelta(seconds=expires_in)).isoformat())  
+
+
+    def generate_spotify_api_token(self):
+        # This function generates a Spotify API token using the client credentials flow.
+        url = "https://accounts.spotify.com/api/token"
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Authorization": f"Basic {self.btoa(self.client_id + ':' + self.client_secret)}"  ,
+        }
+        data = {
+            "code": self.client_code,
+            "redirect_uri": self.redirect_uri,  # Replace with your redirect URI
+            "grant_type": "authorization_code",
+        }
+
+        response = self.api_client.post(url, headers=headers, data=data)
+        if response.status_code == 200:
+            response_json = response.json() # .get("access_token")
+            access_token = response_json.get("access_token")
+            refresh_token = response_json.get("refresh_token")
+            expires_in = response_json.get("expires_in") # in seconds
+            
+            # Set the access token, refresh token, and expiration time in environment variables
+            self.set_token_info(access_token, refresh_token, expires_in)
+            return access_token
+
+        else:
+            print(f"Response: {response.json()}")
+            raise Exception("Failed to generate Spotify API token. Check your credentials.")
+
+
+    def refresh_spotify_api_token(self):
+        refresh_token = self.config.get_config_value('Spotify_API', 'SPOTIFY_REFRESH_TOKEN') 
+        if not refresh_token:
+            raise Exception("Refresh token is not set. Please generate a new access token.")
+        # This function refreshes the Spotify API token using the refresh token.
+        url = "https://accounts.spotify.com/api/token"
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Authorization": f"Basic {self.btoa(self.client_id + ':' + self.client_secret)}",
+        }
+        data = {
+            "refresh_token": refresh_token,
+            "grant_type": "refresh_token",
+        }
+
+        response = self.api_client.post(url, headers=headers, data=data)
+        if response.status_code == 200:
+            response_json = response.json() # .get("access_token")
+            access_token = response_json.get("access_token")
+            refresh_token = response_json.get("refresh_token")
+            expires_in = response_json.get("expires_in") # in seconds
+            
+            # There are instances depending on the grant type where the refresh token is not returned in the response and the access token is returned instead.
+            # In this case, the script can use the previously stored access token
+            if refresh_token is None and access_token is not None:
+                # Store the new access token with its expiration so the next run reuses it instead of refreshing again
+                with self.config.batch():
+                    self.config.set_config_value('Spotify_API', 'SPOTIFY_ACCESS_TOKEN', access_token)
+                    self.config.set_config_value('Spotify_API', 'SPOTIFY_ACCESS_TOKEN_EXPIRATION', (datetime.now(timezone.utc) + timedelta(seconds=expires_in)).isoformat())
+                return access_token
+            else:
+                # Set the access token, refresh token, and expiration time in environment variables
+                self.set_token_info(access_token, refresh_token, expires_in)
+                return access_token
+        else:
+            raise Exception("Failed to refresh Spotify API token. Check your credentials.")
+
+
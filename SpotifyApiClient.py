@@ -0,0 +1,184 @@
+import time
+import random
+import threading
+import contextlib
+import email.utils
+from urllib.parse import urlsplit
+
+class SpotifyApiClient:
+    '''
+    Shared HTTP client for the Spotify Web API and accounts endpoints.
+
+    All requests go through one requests.Session, so connections are kept alive and
+    reused instead of paying a TCP and TLS handshake per call. Every request has a
+    timeout. Responses with a status in RETRY_STATUSES and connection errors are
+    retried up to max_retries times with exponential backoff and jitter, waiting at
+    least as long as the Retry-After header asks for. When Retry-After asks for a
+    longer wait than max_backoff the response is returned without retrying, since any
+    earlier retry would be rejected again. Latency, retry and error counts
+    are kept per endpoint and can be read with endpoint_stats. The requests are also
+    counted per thread, so a thread can tell its own requests from those of threads
+    running at the same time; pool threads working for it count on its counter inside
+    counting_for. requests is only imported when the first request is sent, so
+    creating a client costs nothing.
+    '''
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, timeout=(5, 30), max_retries=5, backoff_factor=0.5, max_backoff=60, pool_size=10):
+        self.timeout = timeout  # (connect, read) timeout in seconds of each attempt
+        self.max_retries = max_retries  # Retries after the first attempt before the last response is returned
+        self.backoff_factor = backoff_factor  # First backoff in seconds, doubled on every retry
+        self.max_backoff = max_backoff  # Longest wait between two attempts in seconds
+        self.pool_size = pool_size  # Connections kept alive per host
+        self._session = None
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self.local = threading.local()  # Request counter of each thread
+
+    @property
+    def session(self):
+        with self.stats_lock:
+            if self._session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+            return self._session
+
+    @staticmethod
+    def endpoint_name(method, url) -> str:
+        # Group the counters by method and URL path, e.g. 'GET /v1/search'
+        return f"{method.upper()} {urlsplit(url).path}"
+
+    @staticmethod
+    def retry_after(response):
+        # Seconds the server asked to wait, from a Retry-After header holding either seconds or an HTTP date
+        value = response.headers.get('Retry-After') if response is not None else None
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def backoff(self, attempt, response=None) -> float:
+        # Exponential backoff with full jitter, never shorter than Retry-After
+        delay = random.uniform(0, min(self.max_backoff, self.backoff_factor * (2 ** attempt)))
+        retry_after = self.retry_after(response)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def record(self, endpoint, latency, retries, error):
+        with self.stats_lock:
+            stats = self.stats.setdefault(endpoint, {'calls': 0, 'retries': 0, 'errors': 0, 'total_latency': 0.0, 'max_latency': 0.0})
+            stats['calls'] += 1
+            stats['retries'] += retries
+            stats['errors'] += int(error)
+            stats['total_latency'] += latency
+            stats['max_latency'] = max(stats['max_latency'], latency)
+            self.thread_counter()[0] += 1 + retries
+
+    def request(self, method, url, **kwargs):
+        '''
+        This function sends a request, retrying on rate limiting, server errors and connection errors.
+
+        Parameters:
+        method (str): The HTTP method.
+        url (str): The request URL.
+        kwargs: Passed on to requests.Session.request (headers, params, data ...).
+
+        Returns:
+        requests.Response: The first response that is not retried, or the last one once the retries are used up
+        or the server asks to wait longer than max_backoff.
+        Connection errors are raised once the retries are used up.
+        '''
+        import requests
+        kwargs.setdefault('timeout', self.timeout)
+        endpoint = self.endpoint_name(method, url)
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    self.record(endpoint, time.perf_counter() - start, attempt, True)
+                    raise
+                time.sleep(self.backoff(attempt))
+                attempt += 1
+                continue
+
+            retry_after = self.retry_after(response)
+            if response.status_code in self.RETRY_STATUSES and attempt < self.max_retries and (retry_after is None or retry_after <= self.max_backoff):
+                time.sleep(self.backoff(attempt, response))
+                attempt += 1
+                continue
+
+            self.record(endpoint, time.perf_counter() - start, attempt, response.status_code >= 400)
+            return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request_count(self) -> int:
+        # Number of HTTP requests sent so far, retries included
+        with self.stats_lock:
+            return sum(stats['calls'] + stats['retries'] for stats in self.stats.values())
+
+    def thread_counter(self) -> list:
+        # The current thread's request count, in a one element list so pool threads can share it through counting_for
+        counter = getattr(self.local, 'counter', None)
+        if counter is None:
+            counter = self.local.counter = [0]
+        return counter
+
+    @contextlib.contextmanager
+    def counting_for(self, counter):
+        # Count the requests this thread sends on counter, the thread_counter of the thread it works for
+        previous = getattr(self.local, 'counter', None)
+        self.local.counter = counter
+        try:
+            yield
+        finally:
+            self.local.counter = previous
+
+    def thread_request_count(self) -> int:
+        # Number of HTTP requests sent so far by the current thread and the pool threads working for it, retries included
+        with self.stats_lock:
+            return self.thread_counter()[0]
+
+    def endpoint_stats(self) -> dict:
+        '''
+        This function returns the request counters of every endpoint called so far.
+
+        Returns:
+        dict: For each endpoint, the number of 'calls', 'retries' and 'errors', and the 'average_latency' and 'max_latency' in seconds (including retries).
+        '''
+        with self.stats_lock:
+            return {
+                endpoint: {
+                    'calls': stats['calls'],
+                    'retries': stats['retries'],
+                    'errors': stats['errors'],
+                    'average_latency': stats['total_latency'] / stats['calls'],
+                    'max_latency': stats['max_latency'],
+                }
+                for endpoint, stats in self.stats.items()
+            }
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
@@ -0,0 +1,135 @@
+import json
+import time
+import sqlite3
+import threading
+import collections
+
+class SpotifyResponseCache:
+    '''
+    TTL and LRU cache of decoded Spotify API responses.
+
+    Entries are keyed on an endpoint name and a normalised request key and expire
+    after the TTL of their endpoint. At most max_entries are kept; the least recently
+    used entries are evicted first. When cache_file is given the entries are also
+    stored in a SQLite database, so they survive between runs, and a lookup that
+    misses in memory falls back to the database. Access times of cache hits are kept in
+    memory and written to the database with the next stored entry or on close, so a hit
+    never waits on a disk commit. Values must be JSON serialisable.
+    '''
+
+    MISS = object()  # Returned by get when there is no fresh entry, since None is a valid cached value
+
+    def __init__(self, ttls, max_entries=10000, cache_file=None):
+        self.ttls = ttls  # Seconds an entry of each endpoint stays fresh, endpoints without a TTL are not cached
+        self.max_entries = max_entries
+        self.cache_file = cache_file
+        self.entries = collections.OrderedDict()  # (endpoint, key) -> (expires, value), least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.accessed = {}  # (endpoint, key) -> last access time of hits not yet written to the database
+        self.lock = threading.Lock()
+        self.db = None
+        if cache_file:
+            self.db = sqlite3.connect(cache_file, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS responses (endpoint TEXT, key TEXT, value TEXT, expires REAL, accessed REAL, PRIMARY KEY (endpoint, key))')
+            self.db.execute('DELETE FROM responses WHERE expires <= ?', (time.time(),))
+            self.db.commit()
+
+    @staticmethod
+    def normalise(value) -> str:
+        # Request key that ignores case and surrounding whitespace, e.g. of an artist name
+        return ' '.join(str(value).split()).casefold()
+
+    def get(self, endpoint, key):
+        '''
+        This function looks up a cached response.
+
+        Parameters:
+        endpoint (str): The endpoint name the response was stored under.
+        key (str): The normalised request key.
+
+        Returns:
+        object: The cached value, or SpotifyResponseCache.MISS when there is no fresh entry.
+        '''
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get((endpoint, key))
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end((endpoint, key))
+                self.touch(endpoint, key, now)
+                self.hits += 1
+                return entry[1]
+            self.entries.pop((endpoint, key), None)
+
+            if self.db is not None:
+                row = self.db.execute('SELECT value, expires FROM responses WHERE endpoint = ? AND key = ?', (endpoint, key)).fetchone()
+                if row is not None and row[1] > now:
+                    value = json.loads(row[0])
+                    self.touch(endpoint, key, now)
+                    self.remember(endpoint, key, row[1], value)
+                    self.hits += 1
+                    return value
+
+            self.misses += 1
+            return self.MISS
+
+    def set(self, endpoint, key, value):
+        '''
+        This function stores a response for the TTL of its endpoint.
+
+        Parameters:
+        endpoint (str): The endpoint name.
+        key (str): The normalised request key.
+        value (object): The JSON serialisable response value.
+
+        Returns:
+        None
+        '''
+        ttl = self.ttls.get(endpoint)
+        if not ttl:
+            return
+        now = time.time()
+        expires = now + ttl
+        with self.lock:
+            self.remember(endpoint, key, expires, value)
+            if self.db is not None:
+                self.accessed.pop((endpoint, key), None)
+                self.write_accessed()
+                self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)', (endpoint, key, json.dumps(value), expires, now))
+                # Evict the least recently used rows beyond max_entries
+                self.db.execute('DELETE FROM responses WHERE rowid IN (SELECT rowid FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+                self.db.commit()
+
+    def touch(self, endpoint, key, now):
+        # Mark a stored entry as used so the database evicts in the same order as memory. Caller holds the lock.
+        if self.db is not None:
+            self.accessed[(endpoint, key)] = now
+
+    def write_accessed(self):
+        # Write the pending access times to the database, committed by the caller. Caller holds the lock.
+        if self.accessed:
+            self.db.executemany('UPDATE responses SET accessed = ? WHERE endpoint = ? AND key = ?', [(now, endpoint, key) for (endpoint, key), now in self.accessed.items()])
+            self.accessed.clear()
+
+    def remember(self, endpoint, key, expires, value):
+        # Add an entry to the in-memory LRU, evicting the least recently used ones beyond max_entries. Caller holds the lock.
+        self.entries[(endpoint, key)] = (expires, value)
+        self.entries.move_to_end((endpoint, key))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.accessed.clear()
+            if self.db is not None:
+                self.db.execute('DELETE FROM responses')
+                self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.write_accessed()
+                self.db.commit()
+                self.db.close()
+                self.db = None
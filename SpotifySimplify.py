@@ -0,0 +1,70 @@
+# Flatten Spotify track and artist objects into the records stored in PocketBase
+
+def image_url(images, index):
+    # Local top items from the streaming history carry no images
+    return images[index]['url'] if len(images) > index else None
+
+def simplify_top_songs(top_songs):
+    top_songs_simplified = []
+    for track in top_songs:
+        # artist name
+        artists = ', '.join(artist['name'] for artist in track['artists'])
+        # track name
+        track_name = track['name']
+        # track id
+        track_id = track['id']
+        # track link
+        track_link = track['external_urls']['spotify']
+        # track image 640 x 640
+        track_image_640 = image_url(track['album']['images'], 0)
+        # track image 300 x 300
+        track_image_300 = image_url(track['album']['images'], 1)
+        # track image 64 x 64
+        track_image_64 = image_url(track['album']['images'], 2)
+        # track release date
+        track_release_date = track['album']['release_date']
+        top_songs_simplified.append({
+            'artists': artists,
+            'track_name': track_name,
+            'track_id': track_id,
+            'track_link': track_link,
+            'track_image_640': track_image_640,
+            'track_image_300': track_image_300,
+            'track_image_64': track_image_64,
+            'track_release_date': track_release_date
+        })
+    return top_songs_simplified 
+
+def simplify_top_artists(top_artists):
+    top_artists_simplified = []
+    for artist in top_artists:
+        # artist name
+        artist_name = artist['name']
+        # artist id
+        artist_id = artist['id']
+        # artist link
+        artist_link = artist['external_urls']['spotify']
+        #artist genres
+        artist_genres = ', '.join(artist['genres'])
+        # artist popularity
+        artist_popularity = artist['popularity']
+        # artist followers
+        artist_followers = artist['followers']['total']
+        # artist image 640 x 640
+        artist_image_640 = image_url(artist['images'], 0)
+        # artist image 300 x 300
+        artist_image_300 = image_url(artist['images'], 1)
+        # artist image 64 x 64
+        artist_image_64 = image_url(artist['images'], 2)
+        top_artists_simplified.append({
+            'artist_name': artist_name,
+            'artist_id': artist_id,
+            'artist_link': artist_link,
+            'artist_genres': artist_genres,
+            'artist_popularity': artist_popularity,
+            'artist_followers': artist_followers,
+            'artist_image_640': artist_image_640,
+            'artist_image_300': artist_image_300,
+            'artist_image_64': artist_image_64
+        })
+    return top_artists_simplified
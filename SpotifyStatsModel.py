@@ -1,22 +1,36 @@
 from pocketbase import PocketBase
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import copy
+import threading
 import json
+from StatsWriteCache import StatsWriteCache
 
 class SpotifyStatsModel:
-    def __init__(self, address, collection_name, admin_email, admin_password):
+    # Attribute holding the record ID of each stat, keyed on the stat label
+    RECORD_ID_ATTRIBUTES = {
+        'total_ms_listened': 'total_ms_listened_record_id',
+        'total_ms_listened_last_year': 'total_ms_listened_ly_record_id',
+        'average_ms_listened': 'average_ms_listened_record_id',
+        'top_5_songs_recent': 'top_5_songs_recent_record_id',
+        'top_5_artists_recent': 'top_5_artists_recent_record_id',
+        'mom_ly_ms_listened': 'mom_ms_listened_record_id',
+        'listening_clock_ly': 'listening_clock_ly_record_id',
+    }
+
+    def __init__(self, address, collection_name, admin_email, admin_password, max_in_flight=8, write_cache_file=None, record_ids=None):
         
         self.collection_name = collection_name
+        self.write_cache = StatsWriteCache(write_cache_file) if write_cache_file else None # Hashes of the last written values, None writes every update
+        self.writes_skipped = 0 # Number of updates skipped because the record already held the value
+        self.requests_sent = 0 # Number of requests sent to PocketBase, read with request_count()
+        self.requests_lock = threading.Lock()
+        self.requests_local = threading.local() # Request counter of each thread, read with thread_request_count()
+        self.max_in_flight = max_in_flight # Maximum number of concurrent PocketBase requests when flushing queued updates
+        self.batch_state = threading.local() # Per thread batch() state, so concurrent threads can each run their own batch
         self.address = address
         self.pb = PocketBase(address)
- 
-        # authenticate with the PocketBase server
-        admin_data = self.pb.admins.auth_with_password(
-            email=admin_email,
-            password=admin_password, )
-        
-        if not admin_data.is_valid:
-            raise Exception("Failed to authenticate with PocketBase server. Check your credentials.")
-        
-        self.admin_data = admin_data
+        self.admin_data = self.authenticate(admin_email, admin_password)
 
         # Temporary Poketbase field keys. 
         # IMPLEMENTATION NOTE: These should be replaced and a more dynamic solution should be in place in the future.
@@ -27,11 +41,95 @@ class SpotifyStatsModel:
         self.top_5_artists_recent_record_id = '3726130j114pzzm'
         self.mom_ms_listened_record_id = '723y18jg6z2srvx'
         self.listening_clock_ly_record_id = '7pc06xg3ix8c847'
+        self.set_record_ids(record_ids or {})
+
+    def authenticate(self, admin_email, admin_password):
+        # authenticate with the PocketBase server and return the admin auth data
+        self.count_request()
+        admin_data = self.pb.admins.auth_with_password(
+            email=admin_email,
+            password=admin_password, )
+        
+        if not admin_data.is_valid:
+            raise Exception("Failed to authenticate with PocketBase server. Check your credentials.")
+        
+        return admin_data
+
+    def set_record_ids(self, record_ids):
+        # Replace the record IDs of the stats given in record_ids, keyed on the stat label
+        for label, record_id in record_ids.items():
+            if label not in self.RECORD_ID_ATTRIBUTES:
+                raise Exception(f"Unknown stat '{label}'. Expected one of {', '.join(self.RECORD_ID_ATTRIBUTES)}.")
+            setattr(self, self.RECORD_ID_ATTRIBUTES[label], record_id)
+
+    def for_records(self, record_ids, write_cache_file=None):
+        '''
+        This function returns a model writing to other stat records, e.g. another user's, over this model's authenticated client and connection pool.
+        
+        Parameters:
+        record_ids (dict): Record ID of each stat keyed on the stat label. Stats left out keep this model's record IDs.
+        write_cache_file (str): Write cache file of the new model. None writes every update.
+        
+        Returns:
+        SpotifyStatsModel: The new model. Its write counters and batches are separate from this model's.
+        '''
+        model = copy.copy(self)
+        model.write_cache = StatsWriteCache(write_cache_file) if write_cache_file else None
+        model.writes_skipped = 0
+        model.requests_sent = 0
+        model.requests_lock = threading.Lock()
+        model.requests_local = threading.local()
+        model.batch_state = threading.local()
+        model.set_record_ids(record_ids)
+        return model
+
+
+    @property
+    def pending_updates(self):
+        # Updates queued inside this thread's batch() block, None when writes go out immediately
+        return getattr(self.batch_state, 'pending_updates', None)
+
+    @pending_updates.setter
+    def pending_updates(self, value):
+        self.batch_state.pending_updates = value
+
+    @property
+    def last_batch_results(self):
+        # Per record results of the last batch() block this thread ran
+        return getattr(self.batch_state, 'last_batch_results', None)
+
+    @last_batch_results.setter
+    def last_batch_results(self, value):
+        self.batch_state.last_batch_results = value
+
+    def count_request(self, counter=None):
+        # counter is the thread_counter of the thread the request is sent for, the current thread's when None
+        with self.requests_lock:
+            self.requests_sent += 1
+            (counter or self.thread_counter())[0] += 1
+
+    def request_count(self) -> int:
+        # Number of requests sent to PocketBase so far
+        with self.requests_lock:
+            return self.requests_sent
 
+    def thread_counter(self) -> list:
+        # The current thread's request count, in a one element list so pool threads can count on it
+        counter = getattr(self.requests_local, 'counter', None)
+        if counter is None:
+            counter = self.requests_local.counter = [0]
+        return counter
+
+    def thread_request_count(self) -> int:
+        # Number of requests sent to PocketBase so far by the current thread, including the concurrent writes it started
+        with self.requests_lock:
+            return self.thread_counter()[0]
 
     def update_stats(self, record_id, label, value):
         '''
         This function updates value of a stat
+        Inside a batch() block the update is queued and written when the block exits.
+        The write is skipped when the write cache shows the record already holds this value.
         
         Parameters:
         record_id (str): The record ID of the stat to update.
@@ -40,15 +138,136 @@ class SpotifyStatsModel:
         Returns:
         None
         '''
+        if self.pending_updates is not None:
+            self.pending_updates.append((record_id, label, value))
+            return
+
+        payload = json.dumps({label:value})
+        if self.write_cache is not None and self.write_cache.is_current(record_id, payload):
+            self.writes_skipped += 1
+            return
         
         # Update the total minutes listened to in the PocketBase database
+        self.count_request()
         self.pb.collection(self.collection_name).update(
 
             record_id, # total_ms_listened record id
             {
-                "value": json.dumps({label:value})
+                "value": payload
             }
         )
+
+        if self.write_cache is not None:
+            self.write_cache.record(record_id, payload)
+            self.write_cache.write()
+
+    def update_stats_bulk(self, updates, max_in_flight=None):
+        '''
+        This function writes many stats concurrently.
+        The requests share the PocketBase client's pooled keep-alive connections and at most max_in_flight of them run at once,
+        so the total write time is close to a single round trip for small batches.
+        Updates whose value matches the write cache are skipped without a request.
+        When a record ID appears more than once only its last update is written, like writing the updates one after another.
+        
+        Parameters:
+        updates (list): (record_id, label, value) tuples to write.
+        max_in_flight (int): Maximum number of concurrent requests. Defaults to the max_in_flight given to the constructor.
+        
+        Returns:
+        dict: For each record ID, a dict with the 'label', whether the write succeeded under 'success', whether it was skipped
+        as unchanged under 'skipped' and the error message under 'error' (None on success).
+        '''
+        # One request per record, concurrent requests to the same record would race and the result of one of them would be lost
+        last_updates = {}
+        for record_id, label, value in updates:
+            last_updates.pop(record_id, None)
+            last_updates[record_id] = (label, value)
+
+        results = {}
+        pending = []
+        for record_id, (label, value) in last_updates.items():
+            payload = json.dumps({label:value})
+            if self.write_cache is not None and self.write_cache.is_current(record_id, payload):
+                self.writes_skipped += 1
+                results[record_id] = {'label': label, 'success': True, 'skipped': True, 'error': None}
+            else:
+                pending.append((record_id, label, payload))
+        if not pending:
+            return results
+
+        # the concurrent writes count as requests of the calling thread
+        counter = self.thread_counter()
+
+        def write(update):
+            record_id, label, payload = update
+            try:
+                self.count_request(counter)
+                self.pb.collection(self.collection_name).update(record_id, {"value": payload})
+                return record_id, {'label': label, 'success': True, 'skipped': False, 'error': None}
+            except Exception as e:
+                return record_id, {'label': label, 'success': False, 'skipped': False, 'error': str(e)}
+
+        with ThreadPoolExecutor(max_workers=min(max_in_flight or self.max_in_flight, len(pending))) as executor:
+            written = dict(executor.map(write, pending))
+
+        if self.write_cache is not None:
+            for record_id, label, payload in pending:
+                if written[record_id]['success']:
+                    self.write_cache.record(record_id, payload)
+                else:
+                    # The record may have been partly updated, write it again next time
+                    self.write_cache.forget(record_id)
+            self.write_cache.write()
+
+        results.update(written)
+        return results
+
+    def verify_write_cache(self, record_ids=None):
+        '''
+        This function checks the write cache against the values stored on the server.
+        Records whose server value no longer matches the cached hash are dropped from the cache, so their next update is written.
+        
+        Parameters:
+        record_ids (list): The record IDs to check. Defaults to every record in the cache.
+        
+        Returns:
+        list: The record IDs that were out of date.
+        '''
+        if self.write_cache is None:
+            return []
+
+        stale = []
+        for record_id in list(record_ids if record_ids is not None else self.write_cache.record_ids()):
+            try:
+                self.count_request()
+                record = self.pb.collection(self.collection_name).get_one(record_id)
+                current = self.write_cache.is_current(record_id, getattr(record, 'value', None))
+            except Exception:
+                current = False
+            if not current:
+                self.write_cache.forget(record_id)
+                stale.append(record_id)
+        self.write_cache.write()
+        return stale
+
+    @contextlib.contextmanager
+    def batch(self, max_in_flight=None):
+        '''
+        This function queues every update made inside the block and writes them concurrently with update_stats_bulk when the block exits.
+        The per record results are kept in self.last_batch_results. Batches are tracked per thread, so several threads can run one at the same time.
+        
+        Parameters:
+        max_in_flight (int): Maximum number of concurrent requests when the queue is flushed.
+        
+        Returns:
+        SpotifyStatsModel: This model, for use in a with statement.
+        '''
+        self.pending_updates = []
+        try:
+            yield self
+        finally:
+            updates, self.pending_updates = self.pending_updates, None
+            self.last_batch_results = self.update_stats_bulk(updates, max_in_flight)
     
     def update_total_ms_listened(self, total_ms_listened: int):
         '''
@@ -0,0 +1,315 @@
+from MySpotifyStats import MySpotifyStats
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from collections import OrderedDict
+import os
+import json
+import time
+import argparse
+import datetime
+import threading
+import socketserver
+from Config import Config
+
+# The MySpotifyStats methods the server answers and the query parameters each one takes
+QUERIES = {
+    'get_total_listening': ['range_start', 'range_end'],
+    'get_average_listening': ['range_start', 'range_end'],
+    'get_hour_listened': ['range_start', 'range_end'],
+    'get_total_listening_by_month': ['year'],
+    'get_artist_listening_time': ['artist_name', 'range_start', 'range_end'],
+    'get_local_top_tracks': ['range_start', 'range_end', 'limit', 'by'],
+    'get_local_top_artists': ['range_start', 'range_end', 'limit', 'by'],
+}
+# Parameters a query can not be answered without
+REQUIRED_PARAMETERS = {'artist_name'}
+
+
+def parse_date(value) -> str:
+    # An ISO date or timestamp, the whole value has to parse, its date is used
+    return datetime.datetime.fromisoformat(value.strip()).date().isoformat()
+
+
+def parse_limit(value) -> int:
+    limit = int(value)
+    if limit <= 0:
+        raise ValueError(value)
+    return limit
+
+
+def parse_by(value) -> str:
+    # The rankings get_local_top_item accepts
+    if value not in ('ms_played', 'plays'):
+        raise ValueError(value)
+    return value
+
+
+# Parser of each query parameter, raising ValueError on a value the query would reject.
+# Dates are normalised so equal ranges share a cache entry.
+PARAMETER_PARSERS = {
+    'range_start': parse_date,
+    'range_end': parse_date,
+    'year': int,
+    'limit': parse_limit,
+    'by': parse_by,
+    'artist_name': str,
+}
+
+
+class StatsQueryService:
+    '''
+    Answers stat queries from one streaming history kept loaded in memory.
+
+    Results are memoised in an LRU cache of at most cache_size entries. The export
+    directory is checked for new, changed or removed Streaming_History_Audio files at
+    most once every check_interval seconds; when its signature changed the history is
+    reloaded, parsing only the new files, and the cache is cleared. A result computed
+    from the history a reload replaced is returned but not cached.
+    '''
+
+    def __init__(self, stats, cache_size=1024, check_interval=2.0):
+        self.stats = stats
+        self.cache_size = cache_size  # Maximum number of cached results
+        self.check_interval = check_interval  # Seconds between two checks of the export directory
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.reload_lock = threading.Lock()
+        self.generation = 0  # Incremented on every reload, results of an older generation are not cached
+        self.hits = 0
+        self.misses = 0
+        self.signature = None
+        self.checked_at = 0.0
+        self.loaded_at = None
+
+    def export_signature(self) -> tuple:
+        # Name, size and mtime of every export file, the same files MySpotifyStats.load reads
+        signature = []
+        for f in sorted(os.listdir(self.stats.streaming_history_path)):
+            if 'Streaming_History_Audio' in f:
+                stat = os.stat(os.path.join(self.stats.streaming_history_path, f))
+                signature.append((f, stat.st_size, stat.st_mtime_ns))
+        return tuple(signature)
+
+    def load(self):
+        # Load the history before the first query so it is answered in milliseconds too
+        with self.reload_lock:
+            self.signature = self.export_signature()
+            self.checked_at = time.monotonic()
+            self.stats.load()
+            self.loaded_at = time.time()
+
+    def check_exports(self):
+        '''
+        This function reloads the history and clears the cache when the export files changed since the last check.
+        It only looks at the export directory once every check_interval seconds.
+
+        Returns:
+        bool: True when the history was reloaded.
+        '''
+        if time.monotonic() - self.checked_at < self.check_interval:
+            return False
+        with self.reload_lock:
+            if time.monotonic() - self.checked_at < self.check_interval:
+                return False
+            signature = self.export_signature()
+            self.checked_at = time.monotonic()
+            if signature == self.signature:
+                return False
+            self.stats.reload()
+            self.signature = signature
+            self.loaded_at = time.time()
+            with self.cache_lock:
+                self.generation += 1
+                self.cache.clear()
+            return True
+
+    def parse_parameters(self, query_name, parameters) -> dict:
+        '''
+        This function checks and parses the parameters of a query.
+
+        Parameters:
+        query_name (str): One of QUERIES.
+        parameters (dict): Raw parameter values keyed on name.
+
+        Returns:
+        dict: The parsed parameters. Raises ValueError on unknown, missing or malformed ones.
+        '''
+        allowed = QUERIES[query_name]
+        unknown = [name for name in parameters if name not in allowed]
+        if unknown:
+            raise ValueError(f"Unknown parameter {', '.join(unknown)} for {query_name}. Expected {', '.join(allowed)}.")
+        missing = [name for name in allowed if name in REQUIRED_PARAMETERS and name not in parameters]
+        if missing:
+            raise ValueError(f"{query_name} requires {', '.join(missing)}.")
+        parsed = {}
+        for name, value in parameters.items():
+            try:
+                parsed[name] = PARAMETER_PARSERS[name](value)
+            except ValueError:
+                raise ValueError(f"Invalid {name} '{value}'.")
+        if ('range_start' in parsed) != ('range_end' in parsed):
+            raise ValueError('range_start and range_end must be given together.')
+        return parsed
+
+    def query(self, query_name, parameters) -> tuple:
+        '''
+        This function answers a query, from the cache when the same query was answered before.
+
+        Parameters:
+        query_name (str): One of QUERIES.
+        parameters (dict): Raw parameter values keyed on name.
+
+        Returns:
+        tuple: (result, cached) where cached (bool) is True when the result came from the cache.
+        '''
+        if query_name not in QUERIES:
+            raise KeyError(query_name)
+        parsed = self.parse_parameters(query_name, parameters)
+        self.check_exports()
+
+        key = (query_name, tuple(sorted(parsed.items())))
+        with self.cache_lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key], True
+            self.misses += 1
+            generation = self.generation
+
+        result = getattr(self.stats, query_name)(**parsed)
+        with self.cache_lock:
+            if generation == self.generation:
+                self.cache[key] = result
+                self.cache.move_to_end(key)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return result, False
+
+    def status(self) -> dict:
+        with self.cache_lock:
+            return {
+                'export_files': len(self.signature or ()),
+                'loaded_at': datetime.datetime.fromtimestamp(self.loaded_at).isoformat() if self.loaded_at else None,
+                'generation': self.generation,
+                'cache_entries': len(self.cache),
+                'cache_size': self.cache_size,
+                'cache_hits': self.hits,
+                'cache_misses': self.misses,
+                'queries': list(QUERIES),
+            }
+
+
+def jsonable(value):
+    # JSON only allows string keys, the hour and month totals are keyed on numbers and dates
+    if isinstance(value, dict):
+        return {str(key): jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [jsonable(item) for item in value]
+    if hasattr(value, 'item'):
+        # numpy scalars
+        return value.item()
+    return value
+
+
+class StatsRequestHandler(BaseHTTPRequestHandler):
+    # GET /<query name>?<parameters> answers a query, GET /status describes the server
+    service = None
+
+    def send_json(self, status, body):
+        content = json.dumps(jsonable(body), default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query_name = url.path.strip('/')
+        if query_name == 'status':
+            self.send_json(200, self.service.status())
+            return
+        if query_name not in QUERIES:
+            self.send_json(404, {'error': f"Unknown query '{query_name}'. Expected status or one of {', '.join(QUERIES)}."})
+            return
+
+        # a repeated parameter takes its last value
+        parameters = {name: values[-1] for name, values in parse_qs(url.query, keep_blank_values=True).items()}
+        start = time.perf_counter()
+        try:
+            result, cached = self.service.query(query_name, parameters)
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {'error': f'{type(e).__name__}: {e}'})
+            return
+        self.send_json(200, {'result': result, 'cached': cached, 'seconds': time.perf_counter() - start})
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(service, host='127.0.0.1', port=8765, socket_path=None, verbose=False):
+    '''
+    This function creates the HTTP server answering the queries of service, on a TCP port or on a Unix socket.
+
+    Parameters:
+    service (StatsQueryService): The service answering the queries.
+    host (str): Address to listen on. Ignored when socket_path is given.
+    port (int): Port to listen on. Ignored when socket_path is given.
+    socket_path (str): Unix socket to listen on instead of a TCP port. A stale socket file is replaced.
+    verbose (bool): Log every request to stderr.
+
+    Returns:
+    socketserver.BaseServer: The server, call serve_forever to start answering.
+    '''
+    handler = type('BoundStatsRequestHandler', (StatsRequestHandler,), {'service': service})
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, handler)
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+    server.verbose = verbose
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve stat queries from the streaming history kept loaded in memory.')
+    parser.add_argument('--config', default='config.ini', help='Config file of the user whose history is served.')
+    parser.add_argument('--verbose', action='store_true', help='Log every request.')
+    args = parser.parse_args()
+
+    config = Config(args.config)
+    host = config.get_config_value('Stats_Server', 'STATS_SERVER_HOST', fallback='127.0.0.1')
+    port = int(config.get_config_value('Stats_Server', 'STATS_SERVER_PORT', fallback='8765'))
+    socket_path = config.get_config_value('Stats_Server', 'STATS_SERVER_SOCKET_PATH', fallback='') or None
+    cache_size = int(config.get_config_value('Stats_Server', 'STATS_SERVER_CACHE_SIZE', fallback='1024'))
+    check_interval = float(config.get_config_value('Stats_Server', 'STATS_SERVER_CHECK_INTERVAL', fallback='2'))
+
+    service = StatsQueryService(MySpotifyStats(args.config), cache_size, check_interval)
+    service.load()
+    server = create_server(service, host, port, socket_path, args.verbose)
+    print(f"Serving {', '.join(QUERIES)} on {socket_path or f'http://{host}:{port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == '__main__':
+    main()
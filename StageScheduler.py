@@ -0,0 +1,147 @@
+import time
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+class Stage:
+    '''
+    One step of a pipeline.
+
+    function is called with a dict holding the result of every stage listed in
+    depends_on and its return value becomes this stage's result. A stage that raises
+    is run again up to retries more times, waiting retry_delay seconds, doubled after
+    every attempt, in between. kind is 'io' for stages that mostly wait on the
+    network or 'cpu' for stages that keep a core busy. rows takes the result and
+    returns the row count recorded on the stage's span; by default it is the length
+    of a result that has one.
+    '''
+
+    def __init__(self, name, function, depends_on=(), kind='io', retries=0, retry_delay=1.0, rows=None):
+        if kind not in ('io', 'cpu'):
+            raise Exception(f"Stage kind must be 'io' or 'cpu', not '{kind}'.")
+        self.name = name
+        self.function = function
+        self.depends_on = list(depends_on)
+        self.kind = kind
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.rows = rows
+
+    def count_rows(self, result):
+        if self.rows is not None:
+            return self.rows(result)
+        if hasattr(result, '__len__') and not isinstance(result, str):
+            return len(result)
+        return None
+
+
+class StageScheduler:
+    '''
+    Runs pipeline stages as soon as the stages they depend on have finished.
+
+    Independent stages run concurrently on a thread pool, so network bound stages
+    overlap with each other and with CPU bound ones; at most cpu_slots CPU bound
+    stages run at once so they do not compete for the GIL. A failing stage is retried
+    on its own without rerunning the stages before it. When it still fails, only the
+    stages depending on it are skipped and the rest of the pipeline carries on.
+    '''
+
+    def __init__(self, stages, max_workers=4, cpu_slots=1, instrumentation=None):
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            for dependency in stage.depends_on:
+                if dependency not in self.stages:
+                    raise Exception(f"Stage '{stage.name}' depends on unknown stage '{dependency}'.")
+        self.max_workers = max_workers
+        self.cpu_slots = threading.Semaphore(cpu_slots)
+        self.instrumentation = instrumentation  # Instrumentation each stage runs in a span of, optional
+
+    def select(self, targets=None) -> list:
+        '''
+        This function lists the stages needed to run the targets: the targets and everything they depend on, in dependency order.
+
+        Parameters:
+        targets (list): Stage names to run. Defaults to every stage.
+
+        Returns:
+        list: Stage names, each after its dependencies.
+        '''
+        targets = list(self.stages) if targets is None else list(targets)
+        ordered, visiting, done = [], set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name not in self.stages:
+                raise Exception(f"Unknown stage '{name}'. Expected one of {', '.join(self.stages)}.")
+            if name in visiting:
+                raise Exception(f"Stage '{name}' depends on itself.")
+            visiting.add(name)
+            for dependency in self.stages[name].depends_on:
+                visit(dependency)
+            visiting.discard(name)
+            done.add(name)
+            ordered.append(name)
+
+        for name in targets:
+            visit(name)
+        return ordered
+
+    def run_stage(self, stage, inputs) -> dict:
+        # Run one stage with its retries, returning its outcome instead of raising
+        attempts = 0
+        delay = stage.retry_delay
+        while True:
+            attempts += 1
+            span = self.instrumentation.span(stage.name) if self.instrumentation else contextlib.nullcontext()
+            slot = self.cpu_slots if stage.kind == 'cpu' else contextlib.nullcontext()
+            start = time.perf_counter()
+            try:
+                with slot, span as record:
+                    result = stage.function(inputs)
+                    if record is not None:
+                        record['rows'] = stage.count_rows(result)
+                return {'status': 'ok', 'result': result, 'error': None, 'attempts': attempts, 'seconds': time.perf_counter() - start}
+            except Exception as e:
+                if attempts > stage.retries:
+                    return {'status': 'failed', 'result': None, 'error': f'{type(e).__name__}: {e}', 'attempts': attempts, 'seconds': time.perf_counter() - start}
+                time.sleep(delay)
+                delay *= 2
+
+    def run(self, targets=None) -> dict:
+        '''
+        This function runs the targets and the stages they depend on.
+
+        Parameters:
+        targets (list): Stage names to run. Defaults to every stage.
+
+        Returns:
+        dict: For each selected stage, its 'status' ('ok', 'failed' or 'skipped'), 'result', 'error', number of 'attempts' and 'seconds' taken.
+        '''
+        selected = self.select(targets)
+        outcomes = {}
+        waiting = list(selected)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while waiting or running:
+                # Skip the stages whose dependencies failed and start the ones whose dependencies all succeeded
+                for name in list(waiting):
+                    stage = self.stages[name]
+                    statuses = [outcomes[dependency]['status'] if dependency in outcomes else None for dependency in stage.depends_on]
+                    if any(status in ('failed', 'skipped') for status in statuses):
+                        blocked = [dependency for dependency, status in zip(stage.depends_on, statuses) if status in ('failed', 'skipped')]
+                        outcomes[name] = {'status': 'skipped', 'result': None, 'error': f"Skipped, depends on {', '.join(blocked)}.", 'attempts': 0, 'seconds': 0.0}
+                        waiting.remove(name)
+                    elif all(status == 'ok' for status in statuses):
+                        inputs = {dependency: outcomes[dependency]['result'] for dependency in stage.depends_on}
+                        running[executor.submit(self.run_stage, stage, inputs)] = name
+                        waiting.remove(name)
+
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    outcomes[running.pop(future)] = future.result()
+
+        return {name: outcomes[name] for name in selected}
@@ -0,0 +1,87 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+
+class StatsWriteCache:
+    '''
+    Local record of the last value written to each PocketBase stat record.
+
+    For every record ID the cache keeps a SHA-256 hash of the canonical JSON of the
+    last payload that was written successfully, so an update carrying the same
+    payload can be skipped without asking the server. The hashes are stored in a
+    small JSON file and can be checked against the server with
+    SpotifyStatsModel.verify_write_cache when the records may have been edited
+    elsewhere. The cache can be shared by concurrent batches: changes and writes
+    are serialised by a lock and every write goes through its own temporary file.
+    '''
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file  # JSON file holding the record ID to payload hash mapping
+        self.lock = threading.RLock()
+        self.hashes = self.read()
+
+    @staticmethod
+    def digest(payload) -> str:
+        '''
+        This function hashes a stat payload.
+        A JSON string is decoded first, so the payload sent and the value read back from the server hash the same.
+
+        Parameters:
+        payload (str or object): The JSON payload, or its decoded value.
+
+        Returns:
+        str: The hex SHA-256 digest of the canonical JSON of the payload.
+        '''
+        if isinstance(payload, str):
+            try:
+                payload = json.loads(payload)
+            except ValueError:
+                pass
+        canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def read(self) -> dict:
+        if not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            # A corrupt cache only costs one round of writes
+            return {}
+
+    def write(self):
+        # Replace the file atomically with a unique temporary file in the same directory
+        with self.lock:
+            content = json.dumps(self.hashes, indent=1, sort_keys=True)
+            directory = os.path.dirname(os.path.abspath(self.cache_file))
+            fd, tmp_cache_file = tempfile.mkstemp(prefix='.' + os.path.basename(self.cache_file) + '-', suffix='.tmp', dir=directory)
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(content)
+                os.replace(tmp_cache_file, self.cache_file)
+            except BaseException:
+                if os.path.exists(tmp_cache_file):
+                    os.remove(tmp_cache_file)
+                raise
+
+    def is_current(self, record_id, payload) -> bool:
+        # True when payload is what was last written to record_id
+        digest = self.digest(payload)
+        with self.lock:
+            return self.hashes.get(record_id) == digest
+
+    def record_ids(self) -> list:
+        with self.lock:
+            return list(self.hashes)
+
+    def record(self, record_id, payload):
+        digest = self.digest(payload)
+        with self.lock:
+            self.hashes[record_id] = digest
+
+    def forget(self, record_id):
+        with self.lock:
+            self.hashes.pop(record_id, None)
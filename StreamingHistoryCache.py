@@ -0,0 +1,391 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+import contextlib
+import numpy as np
+import pandas as pd
+from ListeningCube import ListeningCube
+from StreamingHistoryReader import concat_streaming_history
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory file locks on this platform, the store is then not protected against concurrent processes
+    fcntl = None
+
+class StreamingHistoryCache:
+    '''
+    On-disk Parquet store of the prepared streaming history, its listening cube and its track table.
+
+    The manifest records the path, size and modification time of every ingested
+    Streaming_History_Audio file together with the number of rows and the timestamp
+    range it contributed, the timestamp range of every stored Parquet part and the
+    files holding the cube and the track table. On refresh only new or changed files
+    are parsed. Each parsed chunk is deduplicated on ('ts', 'spotify_track_uri')
+    against the stored parts whose range overlaps it and written as a new part, so
+    neither the full history nor a whole export file has to be held in memory. Only
+    the cube rows of the chunks are kept, with dictionary coded artist and track
+    keys, and merged into the stored cube once after the last file. The cube is
+    partitioned by local year and only the years the new rows fall in are
+    rewritten; the new tracks (the name, artist and album of every track URI) are
+    appended as a new track part. A full rebuild only happens when a file was
+    removed, a changed file lost rows (those rows can no longer be told apart from
+    the rest of the history) or the store was written with different settings
+    (ingestion mode or timezone).
+
+    Files are never changed in place: new parts and cube partitions get new names and
+    the manifest is replaced atomically once they are written, so an interrupted
+    refresh leaves the previous store intact. Refreshes and reads hold an exclusive
+    lock on a file in the store directory, so processes sharing a store, e.g. the
+    nightly job and the stats server, never see each other's half written changes.
+    '''
+
+    MANIFEST_VERSION = 8
+    DATA_DIR = 'streaming_history'
+    CUBE_DIR = 'listening_cube'
+    TRACKS_DIR = 'tracks'
+    LOCK_FILE = '.lock'
+    MAX_TRACK_PARTS = 16  # Track parts are compacted into one beyond this many
+    TRACK_COLUMNS = ['spotify_track_uri', 'master_metadata_track_name', 'master_metadata_album_artist_name', 'master_metadata_album_album_name']
+    MANIFEST_FILE = 'manifest.json'
+    DEDUPLICATE_COLUMNS = ['ts', 'spotify_track_uri']
+
+    def __init__(self, cache_path, settings=None):
+        self.cache_path = cache_path  # Directory holding the cached parts, cube and manifest
+        self.settings = settings or {}  # Settings the stored rows depend on, a store written with other settings is rebuilt
+        self.data_dir = os.path.join(cache_path, self.DATA_DIR)
+        self.cube_dir = os.path.join(cache_path, self.CUBE_DIR)
+        self.tracks_dir = os.path.join(cache_path, self.TRACKS_DIR)
+        self.manifest_file = os.path.join(cache_path, self.MANIFEST_FILE)
+        self.manifest = None
+        self.lock = threading.RLock()
+        self.lock_depth = 0
+        self.lock_file = None
+
+    @contextlib.contextmanager
+    def file_lock(self):
+        # Exclusive lock on the store held across processes. It is re-entrant within this object, so refresh can run inside a locked load.
+        with self.lock:
+            if self.lock_depth == 0:
+                os.makedirs(self.cache_path, exist_ok=True)
+                self.lock_file = open(os.path.join(self.cache_path, self.LOCK_FILE), 'a')
+                if fcntl is not None:
+                    fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            self.lock_depth += 1
+            try:
+                yield
+            finally:
+                self.lock_depth -= 1
+                if self.lock_depth == 0:
+                    if fcntl is not None:
+                        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+                    self.lock_file.close()
+                    self.lock_file = None
+
+    @staticmethod
+    def file_signature(path):
+        # Identify a source file by its size and mtime
+        stat = os.stat(path)
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    def read_manifest(self):
+        if not os.path.exists(self.manifest_file):
+            return None
+        try:
+            with open(self.manifest_file, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            # A corrupt manifest is treated the same as a missing one
+            return None
+        if manifest.get('version') != self.MANIFEST_VERSION or manifest.get('settings') != self.settings:
+            return None
+        return manifest
+
+    def write_manifest(self, manifest):
+        # Replace the manifest atomically through a unique temporary file
+        fd, tmp_manifest_file = tempfile.mkstemp(prefix='.manifest-', suffix='.tmp', dir=self.cache_path)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(manifest, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_manifest_file, self.manifest_file)
+        except BaseException:
+            if os.path.exists(tmp_manifest_file):
+                os.remove(tmp_manifest_file)
+            raise
+
+    def stored_files(self, manifest) -> list:
+        # Paths of every part, cube partition and track part the manifest refers to
+        return (
+            [os.path.join(self.data_dir, name) for name in manifest['parts']]
+            + [os.path.join(self.cube_dir, name) for name in manifest['cube_parts'].values()]
+            + [os.path.join(self.tracks_dir, name) for name in manifest['tracks_parts']]
+        )
+
+    def plan(self, files):
+        '''
+        This function compares the source files against the manifest and decides what has to be ingested.
+
+        Parameters:
+        files (list): The Streaming_History_Audio file paths currently in the export directory.
+
+        Returns:
+        tuple: (rebuild, pending) where rebuild (bool) is True when the store has to be rebuilt from scratch
+        and pending (list) holds the new or changed file paths that still need to be parsed.
+        '''
+        manifest = self.read_manifest()
+        if manifest is None or not all(os.path.exists(path) for path in self.stored_files(manifest)):
+            return True, list(files)
+
+        ingested = manifest['files']
+        current = {os.path.abspath(f): f for f in files}
+        if any(path not in current for path in ingested):
+            # A file was removed from the export directory
+            return True, list(files)
+
+        pending = []
+        for path, f in current.items():
+            entry = ingested.get(path)
+            signature = self.file_signature(f)
+            if entry is None or entry['size'] != signature['size'] or entry['mtime_ns'] != signature['mtime_ns']:
+                pending.append(f)
+        return False, pending
+
+    def parts_in_range(self, ts_start=None, ts_end=None):
+        # Stored parts whose timestamp range overlaps [ts_start, ts_end], in write order
+        if self.manifest is None:
+            self.manifest = self.read_manifest()
+        parts = []
+        for name, part in sorted(self.manifest['parts'].items()):
+            if ts_start is not None and pd.Timestamp(part['ts_max']) < ts_start:
+                continue
+            if ts_end is not None and pd.Timestamp(part['ts_min']) > ts_end:
+                continue
+            parts.append(os.path.join(self.data_dir, name))
+        return parts
+
+    def load_history(self, ts_start=None, ts_end=None, columns=None) -> pd.DataFrame:
+        '''
+        This function reads stored history rows back from the Parquet parts.
+
+        Parameters:
+        ts_start (pd.Timestamp): Only return rows with 'ts' at or after this time.
+        ts_end (pd.Timestamp): Only return rows with 'ts' before or at this time.
+        columns (list): The columns to read, all of them when None.
+
+        Returns:
+        pd.DataFrame: The stored rows in the range, or None if the store holds no rows.
+        '''
+        filters = []
+        if ts_start is not None:
+            filters.append(('ts', '>=', ts_start))
+        if ts_end is not None:
+            filters.append(('ts', '<=', ts_end))
+
+        with self.file_lock():
+            frames = [pd.read_parquet(part, columns=columns, filters=filters or None) for part in self.parts_in_range(ts_start, ts_end)]
+        if not frames:
+            return None
+        return concat_streaming_history(frames)
+
+    @staticmethod
+    def part_year(days) -> np.ndarray:
+        # Local calendar year of integer day numbers, the cube partition key
+        return np.asarray(days, dtype='int64').astype('datetime64[D]').astype('datetime64[Y]').astype(np.int64) + 1970
+
+    def load_cube_part(self, year) -> pd.DataFrame:
+        # Cube rows of one year, None when the store has none
+        name = self.manifest['cube_parts'].get(str(year))
+        return pd.read_parquet(os.path.join(self.cube_dir, name)) if name else None
+
+    def load_cube(self) -> pd.DataFrame:
+        # The cube rows of every year, in day order
+        with self.file_lock():
+            manifest = self.read_manifest()
+            frames = [pd.read_parquet(os.path.join(self.cube_dir, name)) for year, name in sorted(manifest['cube_parts'].items())]
+        if not frames:
+            return pd.DataFrame(columns=ListeningCube.KEYS + ListeningCube.VALUES)
+        return concat_streaming_history(frames)
+
+    def load_tracks(self) -> pd.DataFrame:
+        # The track parts in write order, a later row of a track URI wins
+        with self.file_lock():
+            manifest = self.read_manifest()
+            frames = [pd.read_parquet(os.path.join(self.tracks_dir, name)) for name in manifest['tracks_parts']]
+        if not frames:
+            return pd.DataFrame(columns=self.TRACK_COLUMNS)
+        return self.build_tracks(concat_streaming_history(frames))
+
+    @classmethod
+    def build_tracks(cls, rows: pd.DataFrame) -> pd.DataFrame:
+        # One row per track URI with its name, artist and album, the last occurrence wins. The columns stay categorical, every name is held once.
+        tracks = rows[cls.TRACK_COLUMNS].dropna(subset=['spotify_track_uri'])
+        return tracks.drop_duplicates(subset='spotify_track_uri', keep='last')
+
+    def drop_known_rows(self, new_rows: pd.DataFrame) -> pd.DataFrame:
+        '''
+        This function removes rows that are duplicated within new_rows or already present in the store.
+        Only the stored rows inside the timestamp range of new_rows are read, so the cost follows the size of the new data.
+        '''
+        new_rows = new_rows.drop_duplicates(subset=self.DEDUPLICATE_COLUMNS)
+        if new_rows.empty:
+            return new_rows
+
+        window = self.load_history(new_rows['ts'].min(), new_rows['ts'].max(), columns=self.DEDUPLICATE_COLUMNS)
+        if window is None or window.empty:
+            return new_rows
+
+        known = pd.MultiIndex.from_frame(window)
+        mask = pd.MultiIndex.from_frame(new_rows[self.DEDUPLICATE_COLUMNS]).isin(known)
+        return new_rows.loc[~mask]
+
+    def write_file(self, directory, prefix, rows: pd.DataFrame) -> str:
+        # Write rows to a new Parquet file named after the next part number and return its name
+        name = '{}-{:05d}.parquet'.format(prefix, self.manifest['next_part'])
+        path = os.path.join(directory, name)
+        rows.to_parquet(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+        self.manifest['next_part'] += 1
+        return name
+
+    def write_part(self, rows: pd.DataFrame):
+        # Write rows as the next Parquet part and record its timestamp range
+        name = self.write_file(self.data_dir, 'part', rows)
+        self.manifest['parts'][name] = {'rows': len(rows), 'ts_min': rows['ts'].min().isoformat(), 'ts_max': rows['ts'].max().isoformat()}
+
+    @staticmethod
+    def encode_keys(cube_df: pd.DataFrame, names: dict) -> pd.DataFrame:
+        # Replace the artist and track keys of a chunk cube by integer codes into the names seen by the refresh so far, so every name is held once
+        for column in ('artist', 'track'):
+            column_names = names.setdefault(column, {})
+            values = cube_df[column].array
+            # the trailing -1 keeps the code of missing keys
+            codes = np.array([column_names.setdefault(name, len(column_names)) for name in values.categories] + [-1], dtype=np.int32)
+            cube_df[column] = codes[values.codes]
+        return cube_df
+
+    @staticmethod
+    def decode_keys(cube_df: pd.DataFrame, names: dict) -> pd.DataFrame:
+        # Turn the codes written by encode_keys back into categorical keys
+        for column, column_names in names.items():
+            cube_df[column] = pd.Categorical.from_codes(cube_df[column].to_numpy(), pd.Index(list(column_names)))
+        return cube_df
+
+    def write_cube(self, new_cube_df: pd.DataFrame) -> list:
+        '''
+        This function merges new cube rows into the partitions of the years they fall in and writes those partitions as new files.
+
+        Returns:
+        list: The paths of the partition files the new ones replace, to delete once the manifest is written.
+        '''
+        replaced = []
+        years = self.part_year(new_cube_df['day'].to_numpy())
+        for year in np.unique(years):
+            cube_df = ListeningCube.merge(self.load_cube_part(year), new_cube_df.loc[years == year])
+            name = self.write_file(self.cube_dir, f'cube-{year}', cube_df)
+            previous = self.manifest['cube_parts'].get(str(year))
+            if previous:
+                replaced.append(os.path.join(self.cube_dir, previous))
+            self.manifest['cube_parts'][str(year)] = name
+        return replaced
+
+    def write_tracks(self, new_tracks_df: pd.DataFrame) -> list:
+        '''
+        This function appends new track rows as a track part, compacting the track parts into one when there are too many.
+
+        Returns:
+        list: The paths of the track parts a compaction replaced, to delete once the manifest is written.
+        '''
+        if len(self.manifest['tracks_parts']) < self.MAX_TRACK_PARTS:
+            self.manifest['tracks_parts'].append(self.write_file(self.tracks_dir, 'tracks', new_tracks_df))
+            return []
+        frames = [pd.read_parquet(os.path.join(self.tracks_dir, name)) for name in self.manifest['tracks_parts']]
+        replaced = [os.path.join(self.tracks_dir, name) for name in self.manifest['tracks_parts']]
+        self.manifest['tracks_parts'] = [self.write_file(self.tracks_dir, 'tracks', self.build_tracks(concat_streaming_history(frames + [new_tracks_df])))]
+        return replaced
+
+    def remove_unreferenced(self):
+        # Delete files a crashed refresh wrote but never added to the manifest. Caller holds the lock.
+        referenced = set(self.stored_files(self.manifest))
+        for directory in (self.data_dir, self.cube_dir, self.tracks_dir):
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if path not in referenced:
+                    os.remove(path)
+
+    def refresh(self, files, read_files, rebuild=False) -> pd.DataFrame:
+        '''
+        This function brings the store up to date with the given source files.
+
+        Parameters:
+        files (list): The Streaming_History_Audio file paths currently in the export directory.
+        read_files (callable): Takes a list of source file paths and yields (path, chunks) pairs in the same order, where chunks is an iterable of prepared DataFrames.
+        rebuild (bool): Discard the stored history and ingest every file again.
+
+        Returns:
+        pd.DataFrame: The listening cube rows of the full history.
+        '''
+        with self.file_lock():
+            full_rebuild, pending = self.plan(files)
+
+            if full_rebuild or rebuild:
+                # Nothing of the old store is kept, drop the manifest first so an interrupted rebuild starts over
+                if os.path.exists(self.manifest_file):
+                    os.remove(self.manifest_file)
+                for directory in (self.data_dir, self.cube_dir, self.tracks_dir):
+                    shutil.rmtree(directory, ignore_errors=True)
+                    os.makedirs(directory, exist_ok=True)
+                self.manifest = {'version': self.MANIFEST_VERSION, 'settings': self.settings, 'files': {}, 'parts': {}, 'cube_parts': {}, 'tracks_parts': [], 'next_part': 0}
+                pending = list(files)
+            else:
+                self.manifest = self.read_manifest()
+                if not pending:
+                    return self.load_cube()
+
+            # Parse only the pending files, chunk by chunk, and record what each one contributed.
+            # The chunk cubes are collected and merged into the stored cube once, after the last file.
+            chunk_cubes = []
+            track_frames = []
+            names = {}
+            for f, chunks in read_files(pending):
+                entry = self.file_signature(f)
+                entry.update({'rows': 0, 'ts_min': None, 'ts_max': None})
+                for chunk in chunks:
+                    if chunk.empty:
+                        continue
+                    entry['rows'] += len(chunk)
+                    entry['ts_min'] = min(filter(None, [entry['ts_min'], chunk['ts'].min().isoformat()]))
+                    entry['ts_max'] = max(filter(None, [entry['ts_max'], chunk['ts'].max().isoformat()]))
+
+                    new_rows = self.drop_known_rows(chunk)
+                    if len(new_rows):
+                        self.write_part(new_rows)
+                        chunk_cubes.append(self.encode_keys(ListeningCube.build(new_rows), names))
+                        # Fold the chunk tracks into one table whenever they outgrow it, so a track seen in many chunks is not held many times
+                        track_frames.append(self.build_tracks(new_rows))
+                        if sum(len(frame) for frame in track_frames[1:]) > len(track_frames[0]):
+                            track_frames = [self.build_tracks(concat_streaming_history(track_frames))]
+
+                previous = self.manifest['files'].get(os.path.abspath(f))
+                if previous is not None and entry['rows'] < previous['rows']:
+                    # A changed file lost rows that are already in the store, start over
+                    return self.refresh(files, read_files, rebuild=True)
+
+                self.manifest['files'][os.path.abspath(f)] = entry
+
+            replaced = []
+            if chunk_cubes:
+                replaced += self.write_cube(self.decode_keys(pd.concat(chunk_cubes, ignore_index=True), names))
+                replaced += self.write_tracks(self.build_tracks(concat_streaming_history(track_frames)))
+            del chunk_cubes, track_frames
+
+            # The new files only become part of the store once the manifest refers to them
+            self.write_manifest(self.manifest)
+            for path in replaced:
+                if os.path.exists(path):
+                    os.remove(path)
+            self.remove_unreferenced()
+            return self.load_cube()
@@ -0,0 +1,215 @@
+import json
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# Load schema of the streaming history: the columns the statistics use and their dtypes.
+# Every other field of the export is dropped while loading. The repeated string fields are
+# stored as categoricals and 'ts' is parsed separately by prepare_streaming_history.
+STREAMING_HISTORY_SCHEMA = {
+    'ts': 'object',
+    'ms_played': 'int32',
+    'master_metadata_track_name': 'category',
+    'master_metadata_album_artist_name': 'category',
+    'master_metadata_album_album_name': 'category',
+    'spotify_track_uri': 'category',
+}
+STREAMING_HISTORY_COLUMNS = list(STREAMING_HISTORY_SCHEMA)
+
+JSON_WHITESPACE = ' \t\r\n'
+# Characters that can follow a complete array element
+JSON_DELIMITERS = JSON_WHITESPACE + ',]'
+
+
+def iter_json_array(path, block_size=1 << 20):
+    '''
+    This function yields the elements of a top level JSON array one at a time.
+    The file is read in blocks of block_size characters and only the current block and the element being decoded are held in memory.
+
+    Parameters:
+    path (str): Path to a file containing a JSON array.
+    block_size (int): Number of characters read from the file at a time.
+
+    Returns:
+    generator: The decoded array elements in file order.
+    '''
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer, pos, started, eof = '', 0, False, False
+        while True:
+            # Skip whitespace and the separators between elements, reading more of the file when the buffer runs out
+            while True:
+                while pos < len(buffer) and (buffer[pos] in JSON_WHITESPACE or (started and buffer[pos] == ',')):
+                    pos += 1
+                if pos < len(buffer):
+                    break
+                block = f.read(block_size)
+                if not block:
+                    raise ValueError(f"{path} ended before the closing bracket of its JSON array.")
+                buffer, pos = block, 0
+
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError(f"{path} does not contain a JSON array.")
+                started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == ']':
+                return
+
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The element continues past the end of the buffer
+                block = f.read(block_size)
+                if not block:
+                    raise
+                buffer, pos = buffer[pos:] + block, 0
+                continue
+
+            if not eof and (end == len(buffer) or buffer[end] not in JSON_DELIMITERS):
+                # A number cut at the end of the buffer decodes as a shorter one, decode it again with more of the file
+                block = f.read(block_size)
+                if block:
+                    buffer, pos = buffer[pos:] + block, 0
+                    continue
+                eof = True
+
+            yield element
+            pos = end
+
+
+def iter_streaming_history_chunks(path, chunk_size=100000, columns=STREAMING_HISTORY_COLUMNS):
+    '''
+    This function parses a Streaming_History_Audio file incrementally into DataFrames of at most chunk_size rows.
+    Only the requested columns are kept, so peak memory follows the chunk size rather than the file size.
+
+    Parameters:
+    path (str): Path to a Streaming_History_Audio JSON file.
+    chunk_size (int): Maximum number of rows per chunk.
+    columns (list): The record fields to keep.
+
+    Returns:
+    generator: Raw (not yet prepared) DataFrames in file order.
+    '''
+    records = []
+    for record in iter_json_array(path):
+        records.append({column: record.get(column) for column in columns})
+        if len(records) >= chunk_size:
+            yield pd.DataFrame.from_records(records, columns=columns)
+            records = []
+    if records:
+        yield pd.DataFrame.from_records(records, columns=columns)
+
+
+def apply_schema(streaming_history_df: pd.DataFrame) -> pd.DataFrame:
+    # Keep only the schema columns, adding any the export file lacks, and narrow them to the schema dtypes
+    streaming_history_df = streaming_history_df.reindex(columns=STREAMING_HISTORY_COLUMNS)
+    streaming_history_df['ms_played'] = streaming_history_df['ms_played'].fillna(0)
+    return streaming_history_df.astype({column: dtype for column, dtype in STREAMING_HISTORY_SCHEMA.items() if column != 'ts'})
+
+
+def prepare_streaming_history(streaming_history_df: pd.DataFrame, timezone_name) -> pd.DataFrame:
+    '''
+    This function applies the load schema, parses 'ts' as UTC and adds the integer local time keys.
+    The keys are computed in one vectorised pass over the local wall clock time in seconds:
+    'day' (int32 days since 1970-01-01) and 'hour' (int8 hour of the day). Months are grouped from the day keys when needed.
+
+    Parameters:
+    streaming_history_df (pd.DataFrame): Raw rows of a Streaming_History_Audio file.
+    timezone_name (str): The IANA timezone the local time keys are computed in.
+
+    Returns:
+    pd.DataFrame: The prepared rows.
+    '''
+    streaming_history_df = apply_schema(streaming_history_df)
+    streaming_history_df['ts'] = pd.to_datetime(streaming_history_df['ts'], utc=True)
+
+    local_seconds = streaming_history_df['ts'].dt.tz_convert(timezone_name).dt.tz_localize(None).to_numpy().astype('datetime64[s]')
+    seconds = local_seconds.astype(np.int64)
+    streaming_history_df['day'] = (seconds // 86400).astype(np.int32)
+    streaming_history_df['hour'] = (seconds % 86400 // 3600).astype(np.int8)
+    return streaming_history_df
+
+
+def concat_streaming_history(frames) -> pd.DataFrame:
+    '''
+    This function concatenates prepared streaming history frames, or listening cube rows, while keeping the categorical columns categorical.
+    pd.concat falls back to object dtype when the categories differ between frames, so the categories are unioned first.
+    '''
+    frames = list(frames)
+    if len(frames) == 1:
+        return frames[0].reset_index(drop=True)
+
+    categorical_columns = [column for column in frames[0] if isinstance(frames[0][column].dtype, pd.CategoricalDtype)]
+    columns = {column: union_categoricals([frame[column] for frame in frames]) for column in categorical_columns}
+    other = pd.concat([frame.drop(columns=categorical_columns) for frame in frames], ignore_index=True)
+    for column, values in columns.items():
+        other[column] = values
+    return other[list(frames[0].columns)]
+
+
+def memory_footprint(df: pd.DataFrame) -> dict:
+    # Bytes held by each column (including the index) and in total, counting the contents of object columns
+    usage = df.memory_usage(index=True, deep=True)
+    footprint = {column: int(size) for column, size in usage.items()}
+    footprint['total'] = int(usage.sum())
+    return footprint
+
+
+def parse_streaming_history_file(path, timezone_name) -> pd.DataFrame:
+    # Parse and prepare a whole export file. Runs in the worker processes, so it must stay a module level function.
+    return prepare_streaming_history(pd.read_json(path), timezone_name)
+
+
+def iter_streaming_history_files(files, timezone_name, workers=1, low_memory=False, chunk_size=100000):
+    '''
+    This function parses export files and yields their prepared rows file by file, in the order of files.
+
+    Whole files are parsed across a pool of worker processes with at most workers files in flight, so results
+    never pile up faster than the caller consumes them. Low memory mode streams each file in chunks in this process
+    instead, since a worker has to hand back a whole file at once.
+
+    Parameters:
+    files (list): The Streaming_History_Audio file paths to parse.
+    timezone_name (str): The IANA timezone the local time columns are converted to.
+    workers (int): Number of worker processes. 1 parses in this process.
+    low_memory (bool): Stream each file in chunks of chunk_size rows with only the needed columns.
+    chunk_size (int): Maximum number of rows per chunk in low memory mode.
+
+    Returns:
+    generator: (path, chunks) pairs where chunks is a list or generator of prepared DataFrames.
+    '''
+    if low_memory:
+        for path in files:
+            yield path, (prepare_streaming_history(chunk, timezone_name) for chunk in iter_streaming_history_chunks(path, chunk_size))
+        return
+
+    workers = max(1, min(workers, len(files)))
+    if workers == 1:
+        for path in files:
+            yield path, [parse_streaming_history_file(path, timezone_name)]
+        return
+
+    # Spawn rather than fork: the caller may run other threads, e.g. the UpdateSpotifyStats stages, and forking a
+    # threaded process can copy locks they hold into the workers. Spawned workers stay children of this process,
+    # so their CPU time still shows up in the child CPU time of the instrumentation spans.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        in_flight = collections.deque()
+        remaining = iter(files)
+        for path in remaining:
+            in_flight.append((path, executor.submit(parse_streaming_history_file, path, timezone_name)))
+            if len(in_flight) >= workers:
+                break
+        while in_flight:
+            path, future = in_flight.popleft()
+            result = future.result()
+            # Keep the pool busy while the caller handles this file
+            for next_path in remaining:
+                in_flight.append((next_path, executor.submit(parse_streaming_history_file, next_path, timezone_name)))
+                break
+            yield path, [result]
@@ -0,0 +1,110 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+# Fields of a Streaming_History_Audio record in the order Spotify exports them
+EXPORT_FIELDS = [
+    'ts', 'platform', 'ms_played', 'conn_country', 'ip_addr',
+    'master_metadata_track_name', 'master_metadata_album_artist_name', 'master_metadata_album_album_name', 'spotify_track_uri',
+    'episode_name', 'episode_show_name', 'spotify_episode_uri',
+    'audiobook_title', 'audiobook_uri', 'audiobook_chapter_uri', 'audiobook_chapter_title',
+    'reason_start', 'reason_end', 'shuffle', 'skipped', 'offline', 'offline_timestamp', 'incognito_mode',
+]
+PLATFORMS = ['android', 'ios', 'windows', 'osx', 'web_player']
+COUNTRIES = ['BB', 'US', 'GB', 'CA', 'TT']
+REASONS_START = ['trackdone', 'clickrow', 'fwdbtn', 'backbtn', 'playbtn', 'appload']
+REASONS_END = ['trackdone', 'endplay', 'fwdbtn', 'backbtn', 'logout', 'unexpected-exit']
+
+
+def generate_streaming_history(output_dir, rows, rows_per_file=15000, artists=None, tracks_per_artist=20, start='2015-01-01', end='2025-12-31', episode_share=0.02, seed=0):
+    '''
+    This function writes a deterministic synthetic Spotify extended streaming history export.
+
+    Files are named and shaped like Spotify's Streaming_History_Audio_<years>_<n>.json files and hold every field of the
+    real export. Plays are spread over [start, end) in time order, artists and tracks are drawn from a Zipf like
+    distribution so a few of them dominate like in real listening, and a share of the rows are podcast episodes with
+    empty track fields. The same arguments always produce the same files. Files are written one at a time, so the
+    memory used follows rows_per_file rather than rows.
+
+    Parameters:
+    output_dir (str): Directory the export files are written to. It is created if missing.
+    rows (int): Total number of plays.
+    rows_per_file (int): Maximum number of plays per file.
+    artists (int): Number of distinct artists. Defaults to a number that grows with rows.
+    tracks_per_artist (int): Number of distinct tracks per artist.
+    start (str): First day of the history.
+    end (str): Day after the last day of the history.
+    episode_share (float): Share of the plays that are podcast episodes.
+    seed (int): Random seed.
+
+    Returns:
+    list: The paths of the written files.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    if artists is None:
+        artists = max(50, int(rows ** 0.5))
+
+    # Sorted play times spread evenly over the range with a little jitter
+    start_s = pd.Timestamp(start, tz='UTC').value // 10**9
+    end_s = pd.Timestamp(end, tz='UTC').value // 10**9
+    step = (end_s - start_s) / max(rows, 1)
+
+    artist_weights = 1.0 / np.arange(1, artists + 1)
+    artist_weights /= artist_weights.sum()
+    track_weights = 1.0 / np.arange(1, tracks_per_artist + 1) ** 0.8
+    track_weights /= track_weights.sum()
+
+    paths = []
+    for file_number, first in enumerate(range(0, rows, rows_per_file)):
+        n = min(rows_per_file, rows - first)
+        seconds = start_s + ((first + np.arange(n)) * step + rng.uniform(0, step, n)).astype(np.int64)
+        ts = pd.to_datetime(seconds, unit='s', utc=True).strftime('%Y-%m-%dT%H:%M:%SZ')
+        artist = rng.choice(artists, size=n, p=artist_weights)
+        track = rng.choice(tracks_per_artist, size=n, p=track_weights)
+        ms_played = rng.integers(0, 360000, size=n)
+        episode = rng.random(n) < episode_share
+        platform = rng.integers(0, len(PLATFORMS), size=n)
+        country = rng.integers(0, len(COUNTRIES), size=n)
+        reason_start = rng.integers(0, len(REASONS_START), size=n)
+        reason_end = rng.integers(0, len(REASONS_END), size=n)
+        flags = rng.random((n, 4)) < [0.5, 0.1, 0.05, 0.01]
+
+        records = []
+        for i in range(n):
+            a, t = int(artist[i]), int(track[i])
+            is_episode = bool(episode[i])
+            records.append({
+                'ts': ts[i],
+                'platform': PLATFORMS[platform[i]],
+                'ms_played': int(ms_played[i]),
+                'conn_country': COUNTRIES[country[i]],
+                'ip_addr': f'10.0.{a % 256}.{t}',
+                'master_metadata_track_name': None if is_episode else f'Track {a}-{t}',
+                'master_metadata_album_artist_name': None if is_episode else f'Artist {a}',
+                'master_metadata_album_album_name': None if is_episode else f'Album {a}-{t // 10}',
+                'spotify_track_uri': None if is_episode else f'spotify:track:{a:011d}{t:011d}',
+                'episode_name': f'Episode {a}-{t}' if is_episode else None,
+                'episode_show_name': f'Show {a % 20}' if is_episode else None,
+                'spotify_episode_uri': f'spotify:episode:{a:011d}{t:011d}' if is_episode else None,
+                'audiobook_title': None,
+                'audiobook_uri': None,
+                'audiobook_chapter_uri': None,
+                'audiobook_chapter_title': None,
+                'reason_start': REASONS_START[reason_start[i]],
+                'reason_end': REASONS_END[reason_end[i]],
+                'shuffle': bool(flags[i, 0]),
+                'skipped': bool(flags[i, 1]),
+                'offline': bool(flags[i, 2]),
+                'offline_timestamp': int(seconds[i]) if flags[i, 2] else None,
+                'incognito_mode': bool(flags[i, 3]),
+            })
+
+        first_year, last_year = ts[0][:4], ts[-1][:4]
+        years = first_year if first_year == last_year else f'{first_year}-{last_year}'
+        path = os.path.join(output_dir, f'Streaming_History_Audio_{years}_{file_number}.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(records, f)
+        paths.append(path)
+    return paths
@@ -1,117 +1,183 @@
 from MySpotifyStats import MySpotifyStats
 from SpotifyStatsModel import SpotifyStatsModel
+import argparse
 import datetime as dt
 from Config import Config
+from SpotifySimplify import simplify_top_songs, simplify_top_artists
+from Instrumentation import Instrumentation
+from StageScheduler import Stage, StageScheduler
 
-def simplify_top_songs(top_songs):
-    top_songs_simplified = []
-    for track in top_songs:
-        # artist name
-        artists = ', '.join(artist['name'] for artist in track['artists'])
-        # track name
-        track_name = track['name']
-        # track id
-        track_id = track['id']
-        # track link
-        track_link = track['external_urls']['spotify']
-        # track image 640 x 640
-        track_image_640 = track['album']['images'][0]['url']
-        # track image 300 x 300
-        track_image_300 = track['album']['images'][1]['url']
-        # track image 64 x 64
-        track_image_64 = track['album']['images'][2]['url']
-        # track release date
-        track_release_date = track['album']['release_date']
-        top_songs_simplified.append({
-            'artists': artists,
-            'track_name': track_name,
-            'track_id': track_id,
-            'track_link': track_link,
-            'track_image_640': track_image_640,
-            'track_image_300': track_image_300,
-            'track_image_64': track_image_64,
-            'track_release_date': track_release_date
-        })
-    return top_songs_simplified 
-
-def simplify_top_artists(top_artists):
-    top_artists_simplified = []
-    for artist in top_artists:
-        # artist name
-        artist_name = artist['name']
-        # artist id
-        artist_id = artist['id']
-        # artist link
-        artist_link = artist['external_urls']['spotify']
-        #artist genres
-        artist_genres = ', '.join(artist['genres'])
-        # artist popularity
-        artist_popularity = artist['popularity']
-        # artist followers
-        artist_followers = artist['followers']['total']
-        # artist image 640 x 640
-        artist_image_640 = artist['images'][0]['url']
-        # artist image 300 x 300
-        artist_image_300 = artist['images'][1]['url']
-        # artist image 64 x 64
-        artist_image_64 = artist['images'][2]['url']
-        top_artists_simplified.append({
-            'artist_name': artist_name,
-            'artist_id': artist_id,
-            'artist_link': artist_link,
-            'artist_genres': artist_genres,
-            'artist_popularity': artist_popularity,
-            'artist_followers': artist_followers,
-            'artist_image_640': artist_image_640,
-            'artist_image_300': artist_image_300,
-            'artist_image_64': artist_image_64
-        })
-    return top_artists_simplified
-
-# set config variables
-config = Config('config.ini')
-
-pocketbase_url = config.get_config_value('PocketBase', 'POCKETBASE_URL')
-admin_email = config.get_config_value('PocketBase', 'POCKETBASE_ADMIN_EMAIL')
-admin_password = config.get_config_value('PocketBase', 'POCKETBASE_ADMIN_PASSWORD')
-collection_name = config.get_config_value('PocketBase', 'POCKETBASE_COLLECTION_NAME')
-
-stats = MySpotifyStats()
-stats_model = SpotifyStatsModel(pocketbase_url, collection_name, admin_email, admin_password)
-
-
-# get dates for beginning of last year and end of last year
-start_date = dt.date(dt.datetime.now().year - 1, 1, 1)
-end_date = dt.date(dt.datetime.now().year - 1, 12, 31)
-year = int(dt.datetime.now().year - 1)
-token = stats.get_access_token()
-
-# # update total minutes listened to
-total_ms_listened = stats.get_total_listening()
-stats_model.update_total_ms_listened(total_ms_listened)
-
-# update total minutes listened to last year
-total_ms_listened_last_year = stats.get_total_listening(start_date, end_date)
-stats_model.update_total_ms_listened_last_year(total_ms_listened_last_year)
-
-# # update average minutes listened to
-average_ms_listened = stats.get_average_listening(start_date, end_date)
-stats_model.update_average_ms_listened(average_ms_listened)
-
-# update top 5 songs listened to
-top_5_songs_recent_raw = stats.get_top_tracks(token)
-top_5_songs_recent = simplify_top_songs(top_5_songs_recent_raw)
-stats_model.update_top_5_songs_recent(top_5_songs_recent)
-
-# update top 5 artists listened to
-top_5_artists_recent_raw = stats.get_top_artists(token)
-top_5_artists_recent = simplify_top_artists(top_5_artists_recent_raw)
-stats_model.update_top_5_artists_recent(top_5_artists_recent)
-
-# # update month over month listening stats
-month_over_month_listening_stats = stats.get_total_listening_by_month(year)
-stats_model.update_mom_ly_ms_listened(month_over_month_listening_stats)
-
-# # update listening clock for the year
-listening_clock = stats.get_hour_listened(start_date, end_date)
-stats_model.update_listening_clock_ly(listening_clock)
+# The stats this job can update: the stage that produces each value and the SpotifyStatsModel method that writes it
+STATS = {
+    'total_ms_listened': ('compute_stats', 'update_total_ms_listened'),
+    'total_ms_listened_last_year': ('compute_stats', 'update_total_ms_listened_last_year'),
+    'average_ms_listened': ('compute_stats', 'update_average_ms_listened'),
+    'mom_ly_ms_listened': ('compute_stats', 'update_mom_ly_ms_listened'),
+    'listening_clock_ly': ('compute_stats', 'update_listening_clock_ly'),
+    'top_5_songs_recent': ('get_top_tracks', 'update_top_5_songs_recent'),
+    'top_5_artists_recent': ('get_top_artists', 'update_top_5_artists_recent'),
+}
+# The stage writing the stats of each producing stage
+WRITE_STAGES = {
+    'compute_stats': 'write_history_stats',
+    'get_top_tracks': 'write_top_tracks',
+    'get_top_artists': 'write_top_artists',
+}
+
+
+def write_stats_stage(source, stat_names):
+    # Stage function writing the stats produced by source in one concurrent batch, raising when any write failed so the stage is retried.
+    # Writes that succeeded are in the write cache, so a retry only sends the failed ones again.
+    def write(inputs):
+        stats_model = inputs['connect_pocketbase']
+        values = inputs[source]
+        with stats_model.batch():
+            for stat_name in stat_names:
+                getattr(stats_model, STATS[stat_name][1])(values[stat_name])
+        results = stats_model.last_batch_results
+        failed = {record_id: result for record_id, result in results.items() if not result['success']}
+        if failed:
+            raise Exception('; '.join(f"{result['label']} ({record_id}): {result['error']}" for record_id, result in failed.items()))
+        return results
+    return write
+
+
+def history_stat_specs():
+    # compute_stats specs of the history stats: all time totals and last year's totals, average, months and hours
+    # get dates for beginning of last year and end of last year
+    start_date = dt.date(dt.datetime.now().year - 1, 1, 1)
+    end_date = dt.date(dt.datetime.now().year - 1, 12, 31)
+    year = int(dt.datetime.now().year - 1)
+    return [
+        {'name': 'total_ms_listened', 'metric': 'total'},
+        {'name': 'total_ms_listened_last_year', 'metric': 'total', 'range_start': start_date, 'range_end': end_date},
+        {'name': 'average_ms_listened', 'metric': 'average', 'range_start': start_date, 'range_end': end_date},
+        {'name': 'mom_ly_ms_listened', 'metric': 'month', 'year': year},
+        {'name': 'listening_clock_ly', 'metric': 'hour', 'range_start': start_date, 'range_end': end_date},
+    ]
+
+
+def run_update(stats, connect_pocketbase, stat_names=None, retries=2, workers=4, instrumentation=None) -> dict:
+    '''
+    This function runs the update pipeline for one user.
+
+    Parameters:
+    stats (MySpotifyStats): The user's stats.
+    connect_pocketbase (callable): Takes the stage inputs and returns the SpotifyStatsModel writing the user's records.
+    stat_names (list): The stats to update. Defaults to all of them.
+    retries (int): Times a failed stage is retried on its own.
+    workers (int): Stages run at the same time.
+    instrumentation (Instrumentation): Instrumentation the stages run in spans of, optional.
+
+    Returns:
+    dict: The StageScheduler outcome of every stage that ran.
+    '''
+    stat_names = list(STATS) if stat_names is None else list(stat_names)
+    history_specs = history_stat_specs()
+
+    def load_history(inputs):
+        # load the streaming history and its listening cube
+        stats.load()
+        return len(stats.listening_cube.cube_df)
+
+    def compute_stats(inputs):
+        # compute the selected history statistics in one pass over the listening cube
+        return stats.compute_stats([spec for spec in history_specs if spec['name'] in stat_names])
+
+    def get_top_tracks(inputs):
+        return {'top_5_songs_recent': simplify_top_songs(stats.get_top_tracks(inputs['get_access_token']))}
+
+    def get_top_artists(inputs):
+        return {'top_5_artists_recent': simplify_top_artists(stats.get_top_artists(inputs['get_access_token']))}
+
+    # token -> top tracks / artists -> write, and history load -> aggregates -> write.
+    # The network stages overlap with loading the history and each other.
+    stages = [
+        Stage('connect_pocketbase', connect_pocketbase, retries=retries),
+        Stage('get_access_token', lambda inputs: stats.get_access_token(), retries=retries),
+        Stage('load_history', load_history, kind='cpu', rows=lambda cube_rows: cube_rows),
+        Stage('compute_stats', compute_stats, ['load_history'], kind='cpu'),
+        Stage('get_top_tracks', get_top_tracks, ['get_access_token'], retries=retries, rows=lambda result: len(result['top_5_songs_recent'])),
+        Stage('get_top_artists', get_top_artists, ['get_access_token'], retries=retries, rows=lambda result: len(result['top_5_artists_recent'])),
+    ]
+    targets = []
+    for source, write_stage in WRITE_STAGES.items():
+        source_stats = [stat_name for stat_name in stat_names if STATS[stat_name][0] == source]
+        if source_stats:
+            stages.append(Stage(write_stage, write_stats_stage(source, source_stats), ['connect_pocketbase', source], retries=retries))
+            targets.append(write_stage)
+
+    return StageScheduler(stages, max_workers=workers, instrumentation=instrumentation).run(targets)
+
+
+def summarise(outcomes) -> dict:
+    '''
+    This function summarises the outcomes of run_update.
+
+    Returns:
+    dict: The number of stat updates 'written' and 'skipped' as unchanged, and the 'failed' stages with their errors.
+    '''
+    written = skipped = 0
+    failed = {}
+    for name, outcome in outcomes.items():
+        if name in WRITE_STAGES.values() and outcome['status'] == 'ok':
+            written += len(outcome['result'])
+            skipped += sum(result['skipped'] for result in outcome['result'].values())
+        if outcome['status'] != 'ok':
+            failed[name] = f"{outcome['status']} after {outcome['attempts']} attempt(s): {outcome['error']}"
+    return {'written': written, 'skipped': skipped, 'failed': failed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute the Spotify stats and write them to PocketBase.')
+    parser.add_argument('--stats', nargs='+', choices=list(STATS), default=list(STATS), help='Only update these stats. Defaults to all of them.')
+    parser.add_argument('--retries', type=int, default=2, help='Times a failed stage is retried on its own.')
+    parser.add_argument('--workers', type=int, default=4, help='Stages run at the same time.')
+    args = parser.parse_args()
+
+    # set config variables
+    config = Config('config.ini')
+
+    pocketbase_url = config.get_config_value('PocketBase', 'POCKETBASE_URL')
+    admin_email = config.get_config_value('PocketBase', 'POCKETBASE_ADMIN_EMAIL')
+    admin_password = config.get_config_value('PocketBase', 'POCKETBASE_ADMIN_PASSWORD')
+    collection_name = config.get_config_value('PocketBase', 'POCKETBASE_COLLECTION_NAME')
+    max_in_flight = int(config.get_config_value('PocketBase', 'POCKETBASE_MAX_IN_FLIGHT', fallback='8'))
+    write_cache_file = config.get_config_value('PocketBase', 'POCKETBASE_WRITE_CACHE_PATH', fallback='pocketbase_write_cache.json')
+    verify_write_cache = config.get_config_value('PocketBase', 'POCKETBASE_VERIFY_WRITE_CACHE', fallback='false').strip().lower() in ('1', 'true', 'yes', 'on')
+
+    # instrumentation: every stage runs in a span and the run report is written at the end
+    report_path = config.get_config_value('Instrumentation', 'INSTRUMENTATION_REPORT_PATH', fallback='update_spotify_stats_report.json')
+    profile_stages = [stage.strip() for stage in config.get_config_value('Instrumentation', 'INSTRUMENTATION_PROFILE_STAGES', fallback='').split(',') if stage.strip()]
+    profile_dir = config.get_config_value('Instrumentation', 'INSTRUMENTATION_PROFILE_DIR', fallback='profiles')
+    instrumentation = Instrumentation(profile_stages, profile_dir)
+
+    stats = MySpotifyStats()
+    stats.instrumentation = instrumentation
+    instrumentation.add_http_counter('spotify', stats.api_client.thread_request_count)
+    # time any direct call of the stat methods as well
+    instrumentation.wrap(stats, ['get_total_listening', 'get_total_listening_by_month', 'get_average_listening', 'get_hour_listened', 'get_artist_listening_time'])
+
+    def connect_pocketbase(inputs):
+        stats_model = SpotifyStatsModel(pocketbase_url, collection_name, admin_email, admin_password, max_in_flight, write_cache_file)
+        instrumentation.add_http_counter('pocketbase', stats_model.thread_request_count)
+        if verify_write_cache:
+            # drop cached values that were changed on the server so they are written again
+            stats_model.verify_write_cache()
+        return stats_model
+
+    try:
+        outcomes = run_update(stats, connect_pocketbase, args.stats, args.retries, args.workers, instrumentation)
+    finally:
+        instrumentation.write_report(report_path)
+
+    summary = summarise(outcomes)
+    for name, error in summary['failed'].items():
+        print(f"Stage {name} {error}")
+    print(f"Skipped {summary['skipped']} of {summary['written']} stat updates, values unchanged.")
+    if summary['failed']:
+        raise Exception(f"{len(summary['failed'])} of {len(outcomes)} stages did not complete: {', '.join(summary['failed'])}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+from MySpotifyStats import MySpotifyStats
+from SpotifyStatsModel import SpotifyStatsModel
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from Config import Config
+from UpdateSpotifyStats import STATS, run_update, summarise
+
+# PocketBase settings of the worker processes and the client each of them shares between its users
+worker_settings = {}
+worker_model = None
+worker_model_lock = threading.Lock()
+
+
+def init_worker(settings):
+    # Runs once in every worker process of the pool
+    global worker_settings, worker_model
+    worker_settings = settings
+    worker_model = None
+
+
+def get_worker_model() -> SpotifyStatsModel:
+    # Authenticate on the first use in this process, every later user of the process reuses the client and its connection pool
+    global worker_model
+    with worker_model_lock:
+        if worker_model is None:
+            worker_model = SpotifyStatsModel(
+                worker_settings['pocketbase_url'], worker_settings['collection_name'],
+                worker_settings['admin_email'], worker_settings['admin_password'], worker_settings['max_in_flight'],
+            )
+        return worker_model
+
+
+def load_manifest(manifest_file) -> list:
+    '''
+    This function reads the users of a batch manifest.
+
+    The manifest is a JSON file holding a "users" list. Every user has a "name", the "config_file" with their
+    Spotify tokens and streaming history path, the PocketBase "record_ids" of their stats keyed on the stat label
+    and optionally the "write_cache_path" of their write cache and the "cache_path" of their streaming history store.
+    Every user needs a store of their own, since a store only keeps the export files of one history.
+
+    Parameters:
+    manifest_file (str): Path to the manifest.
+
+    Returns:
+    list: The users, with the paths relative to the manifest resolved and 'base_dir' set to the manifest directory.
+    '''
+    with open(manifest_file, encoding='utf-8') as f:
+        manifest = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+
+    users = []
+    names = set()
+    for user in manifest.get('users', []):
+        for key in ('name', 'config_file', 'record_ids'):
+            if key not in user:
+                raise Exception(f"Manifest user {user.get('name', len(users))} has no '{key}'.")
+        if user['name'] in names:
+            raise Exception(f"Manifest user {user['name']} is listed twice.")
+        missing = [label for label in SpotifyStatsModel.RECORD_ID_ATTRIBUTES if label not in user['record_ids']]
+        if missing:
+            raise Exception(f"Manifest user {user['name']} has no record ID for {', '.join(missing)}.")
+        cache_path = os.path.join(base_dir, user['cache_path']) if user.get('cache_path') else None
+        if cache_path is not None and cache_path in [other['cache_path'] for other in users]:
+            raise Exception(f"Manifest user {user['name']} shares its cache_path with another user.")
+        names.add(user['name'])
+        users.append({
+            'name': user['name'],
+            'config_file': os.path.join(base_dir, user['config_file']),
+            'record_ids': user['record_ids'],
+            'write_cache_path': os.path.join(base_dir, user.get('write_cache_path', f"pocketbase_write_cache_{user['name']}.json")),
+            'cache_path': cache_path,
+            'base_dir': base_dir,
+        })
+    return users
+
+
+def update_user(user, stat_names, retries, workers, history_workers) -> dict:
+    '''
+    This function runs the update pipeline of one user in a worker process.
+
+    Parameters:
+    user (dict): The user, as returned by load_manifest.
+    stat_names (list): The stats to update.
+    retries (int): Times a failed stage is retried on its own.
+    workers (int): Stages of the user run at the same time.
+    history_workers (int): Processes parsing the user's export files.
+
+    Returns:
+    dict: The user's 'name', 'status' ('ok' or 'failed'), 'seconds' taken, number of stat updates 'written' and 'skipped',
+    the 'failed' stages, the 'stage_seconds' of every stage, the 'http_requests' sent and the 'error' that stopped the run, if any.
+    '''
+    start = time.perf_counter()
+    result = {'name': user['name'], 'status': 'failed', 'seconds': 0.0, 'written': 0, 'skipped': 0, 'failed': {}, 'stage_seconds': {}, 'http_requests': {}, 'error': None}
+    stats_models = []
+
+    def connect_pocketbase(inputs):
+        stats_model = get_worker_model().for_records(user['record_ids'], user['write_cache_path'])
+        stats_models.append(stats_model)
+        return stats_model
+
+    try:
+        stats = MySpotifyStats(user['config_file'])
+        # paths in the user's config are relative to the manifest, like the manifest's own paths
+        stats.streaming_history_path = os.path.join(user['base_dir'], stats.streaming_history_path)
+        # the user's own history store and artist table, unless the manifest or their config names one
+        cache_path = user['cache_path'] or stats.config.get_config_value('Spotify_Data', 'SPOTIFY_STREAMING_HISTORY_CACHE_PATH', fallback=None)
+        stats.streaming_history_cache_path = os.path.join(user['base_dir'], cache_path or f"streaming_history_cache_{user['name']}")
+        # the pool already runs one user per core, parsing each export on several more processes would oversubscribe them
+        stats.streaming_history_workers = history_workers
+        outcomes = run_update(stats, connect_pocketbase, stat_names, retries, workers)
+        summary = summarise(outcomes)
+        result.update(summary)
+        result['stage_seconds'] = {name: outcome['seconds'] for name, outcome in outcomes.items()}
+        result['http_requests'] = {'spotify': stats.api_client.request_count(), 'pocketbase': sum(stats_model.request_count() for stats_model in stats_models)}
+        result['status'] = 'failed' if summary['failed'] else 'ok'
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def run_batch(users, settings, stat_names=None, processes=None, retries=2, workers=4) -> dict:
+    '''
+    This function updates the stats of many users, spread over a process pool.
+
+    Users are handed to the worker processes as they become free, so a user with a large export does not hold up the
+    others. Every worker authenticates with PocketBase once and reuses the client and its connection pool for all of its users.
+
+    Parameters:
+    users (list): The users, as returned by load_manifest.
+    settings (dict): The PocketBase 'pocketbase_url', 'collection_name', 'admin_email', 'admin_password' and 'max_in_flight'.
+    stat_names (list): The stats to update. Defaults to all of them.
+    processes (int): Worker processes. Defaults to the CPU count, capped at the number of users.
+    retries (int): Times a failed stage is retried on its own.
+    workers (int): Stages of a user run at the same time.
+
+    Returns:
+    dict: The result of every user in manifest order, as returned by update_user, and the latency summary of the batch.
+    '''
+    stat_names = list(STATS) if stat_names is None else list(stat_names)
+    processes = max(1, min(processes or os.cpu_count() or 1, len(users)))
+    history_workers = max(1, (os.cpu_count() or 1) // processes)
+
+    start = time.perf_counter()
+    results = {}
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_worker, initargs=(settings,)) as executor:
+        futures = {executor.submit(update_user, user, stat_names, retries, workers, history_workers): user['name'] for user in users}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                # the worker process died, e.g. out of memory
+                results[name] = {'name': name, 'status': 'failed', 'seconds': 0.0, 'written': 0, 'skipped': 0, 'failed': {}, 'stage_seconds': {}, 'http_requests': {}, 'error': f'{type(e).__name__}: {e}'}
+            print(f"{name}: {results[name]['status']} in {results[name]['seconds']:.2f}s", file=sys.stderr)
+
+    latencies = sorted(result['seconds'] for result in results.values())
+    return {
+        'users': [results[user['name']] for user in users],
+        'summary': {
+            'users': len(users),
+            'succeeded': sum(result['status'] == 'ok' for result in results.values()),
+            'failed': sum(result['status'] != 'ok' for result in results.values()),
+            'processes': processes,
+            'wall_seconds': time.perf_counter() - start,
+            'median_user_seconds': latencies[len(latencies) // 2] if latencies else 0.0,
+            'max_user_seconds': latencies[-1] if latencies else 0.0,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute the Spotify stats of every user in a manifest and write them to PocketBase.')
+    parser.add_argument('--manifest', required=True, help='JSON file listing the users.')
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes. Defaults to the CPU count.')
+    parser.add_argument('--stats', nargs='+', choices=list(STATS), default=list(STATS), help='Only update these stats. Defaults to all of them.')
+    parser.add_argument('--retries', type=int, default=2, help='Times a failed stage is retried on its own.')
+    parser.add_argument('--workers', type=int, default=4, help='Stages of a user run at the same time.')
+    parser.add_argument('--output', help='Write the per user summary to this JSON file as well.')
+    args = parser.parse_args()
+
+    # the PocketBase server is shared by all users, its settings come from the main config
+    config = Config('config.ini')
+    settings = {
+        'pocketbase_url': config.get_config_value('PocketBase', 'POCKETBASE_URL'),
+        'collection_name': config.get_config_value('PocketBase', 'POCKETBASE_COLLECTION_NAME'),
+        'admin_email': config.get_config_value('PocketBase', 'POCKETBASE_ADMIN_EMAIL'),
+        'admin_password': config.get_config_value('PocketBase', 'POCKETBASE_ADMIN_PASSWORD'),
+        'max_in_flight': int(config.get_config_value('PocketBase', 'POCKETBASE_MAX_IN_FLIGHT', fallback='8')),
+    }
+
+    users = load_manifest(args.manifest)
+    report = run_batch(users, settings, args.stats, args.processes, args.retries, args.workers)
+
+    content = json.dumps(report, indent=2, default=str)
+    print(content)
+    if args.output:
+        with open(args.output + '.tmp', 'w') as f:
+            f.write(content)
+        os.replace(args.output + '.tmp', args.output)
+    if report['summary']['failed']:
+        raise Exception(f"{report['summary']['failed']} of {report['summary']['users']} users did not complete.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import threading
+import pytest
+from Instrumentation import Instrumentation
+from SpotifyApiClient import SpotifyApiClient
+from BenchmarkSpotifyStats import start_stub_pocketbase, stub_stats_model
+
+
+@pytest.fixture
+def stub():
+    server, url = start_stub_pocketbase(latency=0.01)
+    yield url
+    server.shutdown()
+
+
+def test_overlapping_spans_count_only_their_own_requests(stub):
+    api_client = SpotifyApiClient()
+    stats_model = stub_stats_model(stub, max_in_flight=4)
+    instrumentation = Instrumentation()
+    instrumentation.add_http_counter('spotify', api_client.thread_request_count)
+    instrumentation.add_http_counter('pocketbase', stats_model.thread_request_count)
+    # both spans are open while either of them sends its requests
+    opened = threading.Barrier(2)
+    sent = threading.Barrier(2)
+
+    def write_stage():
+        with instrumentation.span('write'):
+            opened.wait()
+            # the bulk write sends its requests from a thread pool
+            stats_model.update_stats_bulk([(f'r{i}', 'total', i) for i in range(5)])
+            sent.wait()
+
+    def fetch_stage():
+        with instrumentation.span('fetch'):
+            opened.wait()
+            for _ in range(3):
+                api_client.get(f'{stub}/api/collections/stats/records/x')
+            stats_model.update_stats('r9', 'total', 1)
+            sent.wait()
+
+    threads = [threading.Thread(target=write_stage), threading.Thread(target=fetch_stage)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    spans = {span['name']: span for span in instrumentation.spans}
+    assert spans['write']['http_requests'] == {'spotify': 0, 'pocketbase': 5}
+    assert spans['fetch']['http_requests'] == {'spotify': 3, 'pocketbase': 1}
+    assert api_client.request_count() == 3
+    assert stats_model.request_count() == 6
@@ -0,0 +1,43 @@
+import json
+import pytest
+from BenchmarkSpotifyStats import start_stub_pocketbase, stub_stats_model
+
+
+@pytest.fixture
+def stub():
+    server, url = start_stub_pocketbase(latency=0.01)
+    yield server, url
+    server.shutdown()
+
+
+def stored_value(server, record_id):
+    return json.loads(server.RequestHandlerClass.records[record_id]['value'])
+
+
+def test_update_stats_bulk_writes_the_last_update_of_a_record(stub):
+    server, url = stub
+    model = stub_stats_model(url, max_in_flight=8)
+    updates = [('r1', 'total', 1), ('r2', 'average', 2), ('r1', 'total', 3), ('r1', 'total', 4)]
+
+    results = model.update_stats_bulk(updates)
+
+    assert model.request_count() == 2
+    assert stored_value(server, 'r1') == {'total': 4}
+    assert stored_value(server, 'r2') == {'average': 2}
+    assert results == {
+        'r1': {'label': 'total', 'success': True, 'skipped': False, 'error': None},
+        'r2': {'label': 'average', 'success': True, 'skipped': False, 'error': None},
+    }
+
+
+def test_update_stats_bulk_write_cache_keeps_the_last_update(stub, tmp_path):
+    server, url = stub
+    model = stub_stats_model(url, write_cache_file=str(tmp_path / 'write_cache.json'))
+    model.update_stats_bulk([('r1', 'total', 1), ('r1', 'total', 2)])
+
+    # the cache holds the written value, so writing it again is skipped and the overwritten one is not
+    results = model.update_stats_bulk([('r1', 'total', 2)])
+    assert results['r1']['skipped']
+    results = model.update_stats_bulk([('r1', 'total', 1)])
+    assert not results['r1']['skipped']
+    assert stored_value(server, 'r1') == {'total': 1}
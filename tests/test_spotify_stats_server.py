@@ -0,0 +1,45 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+import pytest
+from SpotifyStatsServer import StatsQueryService, create_server, parse_date
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2024-01-01', '2024-01-01'),
+    (' 2024-01-01 ', '2024-01-01'),
+    ('2024-01-01T10:00:00', '2024-01-01'),
+    ('2024-01-01T10:00:00+02:00', '2024-01-01'),
+])
+def test_parse_date_accepts_dates_and_timestamps(value, expected):
+    assert parse_date(value) == expected
+
+
+@pytest.mark.parametrize('value', ['2024-01-01T99', '2024-01-01garbage', '2024-13-01', '01/01/2024', ''])
+def test_parse_date_rejects_anything_else(value):
+    with pytest.raises(ValueError):
+        parse_date(value)
+
+
+@pytest.fixture
+def server_url():
+    # Invalid parameters are rejected before the history is needed, so the service runs without one
+    server = create_server(StatsQueryService(None), port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('query', [
+    'range_start=2024-01-01T99&range_end=2024-01-31',
+    'range_start=2024-01-01&range_end=2024-01-31garbage',
+    'range_start=2024-01-01&range_end=2024-01-31&limit=0',
+    'range_start=2024-01-01&range_end=2024-01-31&by=name',
+])
+def test_invalid_parameters_return_400(server_url, query):
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(f'{server_url}/get_local_top_tracks?{query}')
+    assert error.value.code == 400
+    assert 'Invalid' in json.loads(error.value.read())['error']
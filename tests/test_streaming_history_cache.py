@@ -0,0 +1,187 @@
+import os
+import json
+import pytest
+from StreamingHistoryCache import StreamingHistoryCache
+from StreamingHistoryReader import iter_streaming_history_files
+
+
+def play(ts, track, artist='Artist', ms_played=60000):
+    return {
+        'ts': ts,
+        'ms_played': ms_played,
+        'master_metadata_track_name': f'{track} name',
+        'master_metadata_album_artist_name': artist,
+        'master_metadata_album_album_name': 'Album',
+        'spotify_track_uri': f'spotify:track:{track}',
+    }
+
+
+PLAYS_2022 = [play('2022-03-01T10:00:00Z', 'a'), play('2022-03-01T11:00:00Z', 'b'), play('2022-12-31T23:00:00Z', 'a', ms_played=1000)]
+PLAYS_2023 = [play('2023-01-02T08:00:00Z', 'c', 'Other'), play('2023-01-02T09:00:00Z', 'a'), play('2023-06-01T12:00:00Z', 'd')]
+
+
+class ExportDir:
+    # Export directory whose parsed files are recorded, so the tests can check which files a refresh read
+
+    def __init__(self, path, low_memory=True):
+        self.path = path
+        self.low_memory = low_memory
+        self.parsed = []
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, name, plays):
+        with open(os.path.join(self.path, f'Streaming_History_Audio_{name}.json'), 'w', encoding='utf-8') as f:
+            json.dump(plays, f)
+
+    def remove(self, name):
+        os.remove(os.path.join(self.path, f'Streaming_History_Audio_{name}.json'))
+
+    def files(self):
+        return sorted(os.path.join(self.path, f) for f in os.listdir(self.path))
+
+    def read_files(self, files):
+        self.parsed.extend(os.path.basename(f) for f in files)
+        # two rows per chunk, so every file spans several chunks
+        return iter_streaming_history_files(files, 'UTC', low_memory=self.low_memory, chunk_size=2)
+
+
+@pytest.fixture(params=[True, False], ids=['low_memory', 'full'])
+def export(tmp_path, request):
+    return ExportDir(str(tmp_path / 'export'), low_memory=request.param)
+
+
+def refresh(tmp_path, export, **kwargs):
+    cache = StreamingHistoryCache(str(tmp_path / 'cache'), settings={'mode': 'test'})
+    return cache, cache.refresh(export.files(), export.read_files, **kwargs)
+
+
+def totals(cube_df) -> dict:
+    # ms_played and plays per (day, hour, artist, track), independent of row order and categories
+    grouped = cube_df.astype({'artist': object, 'track': object}).groupby(['day', 'hour', 'artist', 'track'], dropna=False)[['ms_played', 'plays']].sum()
+    return {key: tuple(int(value) for value in values) for key, values in grouped.iterrows()}
+
+
+def test_refresh_parses_only_new_files(tmp_path, export):
+    export.write('2022', PLAYS_2022)
+    refresh(tmp_path, export)
+    export.write('2023', PLAYS_2023)
+    export.parsed.clear()
+
+    cache, cube_df = refresh(tmp_path, export)
+
+    assert export.parsed == ['Streaming_History_Audio_2023.json']
+    assert int(cube_df['plays'].sum()) == 6
+    assert len(cache.load_history()) == 6
+    assert sorted(cache.load_tracks()['spotify_track_uri'].astype(str)) == ['spotify:track:a', 'spotify:track:b', 'spotify:track:c', 'spotify:track:d']
+
+    _, rebuilt_df = refresh(tmp_path, export, rebuild=True)
+    assert totals(cube_df) == totals(rebuilt_df)
+
+
+def test_refresh_without_changes_parses_nothing(tmp_path, export):
+    export.write('2022', PLAYS_2022)
+    _, cube_df = refresh(tmp_path, export)
+    export.parsed.clear()
+
+    _, again_df = refresh(tmp_path, export)
+
+    assert export.parsed == []
+    assert totals(again_df) == totals(cube_df)
+
+
+def test_refresh_rewrites_only_touched_years(tmp_path, export):
+    export.write('2022', PLAYS_2022)
+    cache, _ = refresh(tmp_path, export)
+    before = dict(cache.read_manifest()['cube_parts'])
+
+    export.write('2023', PLAYS_2023)
+    cache, _ = refresh(tmp_path, export)
+    after = cache.read_manifest()['cube_parts']
+
+    assert after['2022'] == before['2022']
+    assert set(after) == {'2022', '2023'}
+    # superseded and unreferenced files are removed
+    assert sorted(os.listdir(cache.cube_dir)) == sorted(after.values())
+
+
+def test_refresh_drops_duplicate_plays(tmp_path, export):
+    export.write('2022', PLAYS_2022)
+    refresh(tmp_path, export)
+    # a later export repeating some of the same plays, and a play twice within one file
+    export.write('2022_again', PLAYS_2022[:2] + [PLAYS_2023[0], PLAYS_2023[0]])
+
+    cache, cube_df = refresh(tmp_path, export)
+
+    assert int(cube_df['plays'].sum()) == 4
+    assert len(cache.load_history()) == 4
+    assert int(cube_df['ms_played'].sum()) == 60000 + 60000 + 1000 + 60000
+
+
+def test_removed_file_rebuilds_the_store(tmp_path, export):
+    export.write('2022', PLAYS_2022)
+    export.write('2023', PLAYS_2023)
+    cache, _ = refresh(tmp_path, export)
+
+    export.remove('2022')
+    assert cache.plan(export.files())[0]
+    export.parsed.clear()
+    cache, cube_df = refresh(tmp_path, export)
+
+    assert export.parsed == ['Streaming_History_Audio_2023.json']
+    assert int(cube_df['plays'].sum()) == 3
+    assert len(cache.load_history()) == 3
+    assert set(cache.read_manifest()['cube_parts']) == {'2023'}
+
+
+def test_changed_file_that_lost_rows_rebuilds_the_store(tmp_path, export):
+    export.write('2022', PLAYS_2022)
+    export.write('2023', PLAYS_2023)
+    refresh(tmp_path, export)
+
+    export.write('2022', PLAYS_2022[:1])
+    cache, cube_df = refresh(tmp_path, export)
+
+    assert int(cube_df['plays'].sum()) == 4
+    assert len(cache.load_history()) == 4
+
+
+def test_changed_settings_rebuild_the_store(tmp_path, export):
+    export.write('2022', PLAYS_2022)
+    refresh(tmp_path, export)
+
+    cache = StreamingHistoryCache(str(tmp_path / 'cache'), settings={'mode': 'other'})
+    assert cache.plan(export.files()) == (True, export.files())
+
+
+def test_interrupted_refresh_keeps_the_previous_store(tmp_path, export):
+    export.write('2022', PLAYS_2022)
+    cache, cube_df = refresh(tmp_path, export)
+    manifest = cache.read_manifest()
+
+    export.write('2023', PLAYS_2023)
+
+    def failing_read_files(files):
+        for path, chunks in export.read_files(files):
+            yield path, chunks
+        raise OSError('disk full')
+
+    with pytest.raises(OSError):
+        StreamingHistoryCache(str(tmp_path / 'cache'), settings={'mode': 'test'}).refresh(export.files(), failing_read_files)
+
+    cache = StreamingHistoryCache(str(tmp_path / 'cache'), settings={'mode': 'test'})
+    assert cache.read_manifest() == manifest
+    assert totals(cache.load_cube()) == totals(cube_df)
+    # the next refresh ingests the new file once and removes the parts the interrupted one left behind
+    cache, cube_df = refresh(tmp_path, export)
+    assert int(cube_df['plays'].sum()) == 6
+    assert len(cache.load_history()) == 6
+    assert sorted(os.listdir(cache.data_dir)) == sorted(cache.read_manifest()['parts'])
+
+
+def test_file_lock_is_reentrant(tmp_path):
+    cache = StreamingHistoryCache(str(tmp_path / 'cache'))
+    with cache.file_lock():
+        with cache.file_lock():
+            assert cache.lock_depth == 2
+    assert cache.lock_depth == 0
+    assert cache.lock_file is None
@@ -0,0 +1,53 @@
+import json
+import pytest
+from StreamingHistoryReader import iter_json_array
+
+ELEMENTS = [
+    1234,
+    5678,
+    -12.5e3,
+    'a "quoted", string',
+    {'ts': '2024-01-01T10:00:00Z', 'ms_played': 180000, 'nested': [1, 22, {'deep': 'x y'}]},
+    True,
+    None,
+    [],
+    {},
+    98765,
+]
+
+
+def write_array(tmp_path, elements, indent=None):
+    path = tmp_path / 'array.json'
+    path.write_text(json.dumps(elements, indent=indent), encoding='utf-8')
+    return str(path)
+
+
+@pytest.mark.parametrize('block_size', range(1, 17))
+@pytest.mark.parametrize('indent', [None, 2])
+def test_iter_json_array_elements_cut_at_block_boundaries(tmp_path, block_size, indent):
+    # Every element, including numbers split over two blocks, is decoded whole
+    path = write_array(tmp_path, ELEMENTS, indent)
+    assert list(iter_json_array(path, block_size)) == ELEMENTS
+
+
+def test_iter_json_array_numbers_split_across_blocks(tmp_path):
+    path = write_array(tmp_path, [1234, 5678])
+    assert list(iter_json_array(path, block_size=3)) == [1234, 5678]
+
+
+def test_iter_json_array_empty_array(tmp_path):
+    assert list(iter_json_array(write_array(tmp_path, []), block_size=1)) == []
+
+
+def test_iter_json_array_missing_closing_bracket(tmp_path):
+    path = tmp_path / 'truncated.json'
+    path.write_text('[1, 2, 3', encoding='utf-8')
+    with pytest.raises(ValueError):
+        list(iter_json_array(str(path), block_size=2))
+
+
+def test_iter_json_array_not_an_array(tmp_path):
+    path = tmp_path / 'object.json'
+    path.write_text('{"a": 1}', encoding='utf-8')
+    with pytest.raises(ValueError):
+        list(iter_json_array(str(path)))